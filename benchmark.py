@@ -0,0 +1,168 @@
+"""Offline performance checks for super_script.py.
+
+Run with `python benchmark.py`. Nothing here touches Google Sheets, Yahoo, Gemini or Gmail:
+every external call goes through super_script.SyntheticProviders.
+
+* Micro benchmarks are timed (best of a few runs) against a fixed budget in ms.
+* End-to-end benchmarks run main() on synthetic portfolios of SIZES tickers with
+  HISTORY_DAYS of History_Log, and read per-stage timings from the run report. They fail
+  when a stage is slower than benchmark_baseline.json allows. Refresh the baseline with
+  `python benchmark.py --update-baseline` after an intentional change.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Keep the price cache, history mirror and reports out of the real .cache
+os.environ.setdefault("MARKET_PULSE_CACHE", tempfile.mkdtemp(prefix="market-pulse-bench-"))
+os.environ.setdefault("GMAIL_USER", "bench@example.com")  # From/To headers only; mail goes to NullSMTP
+os.environ.setdefault("MARKET_PULSE_QUIET_MODE", "full")  # time the whole briefing even when no alert fires
+
+import numpy as np
+import pandas as pd
+
+import super_script as ss
+
+REPEATS = 5
+SIZES = (10, 100, 1_000, 10_000)
+HISTORY_DAYS = 5 * 252
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+REGRESSION_TOLERANCE = 0.5  # fail when a stage is >50% slower than baseline...
+REGRESSION_SLACK_MS = 25  # ...and by more than this, so tiny stages don't flap on noise
+
+# Report label -> run-report entry it is read from
+TRACKED_STAGES = {
+    'sheets': 'sheets.batch_get',
+    'fetch': 'stage.market',
+    'fetch_math': 'market.returns',
+    'merges': 'stage.compute',
+    'history': 'stage.history_local',
+    'html': 'render_html',
+    'chart': 'chart.render',
+    'mime': 'email.build_mime',
+}
+
+def synthetic_holdings(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Ticker': [f"T{i:05d}" for i in range(n)],
+        'Price': rng.uniform(1, 1000, n),
+        'Day_Chg_Pct': rng.normal(0, 2, n),
+        'Month_Chg_Pct': rng.normal(0, 8, n),
+        'Total_Gain_Loss': rng.normal(0, 10_000, n),
+    })
+
+def bench_table_render(n=10_000):
+    df = synthetic_holdings(n)
+    return lambda: ss.render_rows(df, ss.HOLDINGS_COLS)
+
+def bench_watchlist_render(n=10_000):
+    df = synthetic_holdings(n)
+    half = n // 2
+    return lambda: ss.render_split_rows(df.iloc[:half], df.iloc[half:], ss.WATCH_COLS)
+
+def synthetic_chart(points=ss.CHART_POINTS, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = np.datetime64('2024-01-02') + np.arange(points).astype('timedelta64[D]')
+    return ss.prepare_chart(dates, 100_000 * np.exp(np.cumsum(rng.normal(0, 0.01, points))))
+
+def bench_chart_render(renderer):
+    def setup():
+        chart = synthetic_chart()
+        return lambda: ss.CHART_RENDERERS[renderer](chart, *ss.CHART_SIZES['email'])
+    return setup
+
+def bench_png_optimize():
+    png = ss.render_matplotlib(synthetic_chart(), *ss.CHART_SIZES['email'])
+    return lambda: ss.optimize_png(png)
+
+# name -> (setup returning a zero-arg callable, budget in ms)
+BENCHMARKS = {
+    'table_render_10k': (bench_table_render, 250),
+    'watchlist_render_10k': (bench_watchlist_render, 250),
+    'chart_matplotlib': (bench_chart_render('matplotlib'), 500),
+    'chart_sparkline': (bench_chart_render('sparkline'), 150),
+    'png_optimize': (bench_png_optimize, 250),
+}
+
+def time_best(fn, repeats=REPEATS):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def run_micro():
+    failed = []
+    for name, (setup, budget_ms) in BENCHMARKS.items():
+        ms = time_best(setup())
+        status = "✅" if ms <= budget_ms else "❌"
+        print(f"{status} {name:<28} {ms:9.1f} ms  (budget {budget_ms} ms)")
+        if ms > budget_ms: failed.append(name)
+    return failed
+
+def bench_end_to_end(n):
+    """Warm-run stage timings (ms) for an n-ticker portfolio: one cold run fills the price
+    cache and history mirror, the second one is what a scheduled run looks like."""
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = ss.SyntheticProviders(n, history_days=HISTORY_DAYS)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ss.run_with_report(f"bench-{n}-cold", ss.main)
+        cold = ss.RUN_REPORT.to_dict()['wall_s'] * 1000
+        # Same series as the cold run: without this the warm chart is just a cached-PNG read
+        shutil.rmtree(ss.CHART_CACHE_DIR, ignore_errors=True)
+        ss.run_with_report(f"bench-{n}", ss.main)
+    report = ss.RUN_REPORT.to_dict()
+
+    timings = {'total': report['wall_s'] * 1000, 'total_cold': cold}
+    for label, entry in TRACKED_STAGES.items():
+        timings[label] = sum(e['wall_s'] for e in report['stages'] if e['name'] == entry) * 1000
+    return timings
+
+def run_end_to_end(sizes, baseline):
+    results, failed = {}, []
+    labels = list(TRACKED_STAGES) + ['total', 'total_cold']
+    print(f"{'tickers':>8} " + " ".join(f"{l:>10}" for l in labels) + "   (ms)")
+    for n in sizes:
+        timings = results[str(n)] = bench_end_to_end(n)
+        print(f"{n:>8} " + " ".join(f"{timings[l]:>10.1f}" for l in labels))
+        for label, ms in timings.items():
+            base = baseline.get(str(n), {}).get(label)
+            if base is not None and ms > base * (1 + REGRESSION_TOLERANCE) + REGRESSION_SLACK_MS:
+                failed.append(f"{label}@{n} {ms:.0f}ms vs baseline {base:.0f}ms")
+    return results, failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="portfolio sizes to run end to end")
+    parser.add_argument("--update-baseline", action="store_true", help=f"write results to {os.path.basename(BASELINE_PATH)}")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH) and not args.update_baseline:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    failed = run_micro()
+    results, regressions = run_end_to_end(args.sizes, baseline)
+    failed += regressions
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump({n: {k: round(v, 1) for k, v in t.items()} for n, t in results.items()}, f, indent=1)
+        print(f"📝 Baseline written to {BASELINE_PATH}")
+    if failed:
+        print("❌ Regressions / over budget:\n  " + "\n  ".join(failed))
+        return 1
+    print("✅ All benchmarks within budget.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
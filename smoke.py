@@ -0,0 +1,486 @@
+"""Offline correctness checks for super_script.py.
+
+Run with `python smoke.py` (or `python smoke.py NAME ...` for a subset). Like benchmark.py,
+nothing here touches Google Sheets, Yahoo, Gemini or Gmail: every external call goes through
+super_script.SyntheticProviders, sometimes with faults injected. Each check raises
+AssertionError on failure; the script exits non-zero if any check fails.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import smtplib
+import subprocess
+import threading
+import time
+import sys
+import tempfile
+import traceback
+
+# Keep the price cache, history mirror and reports out of the real .cache
+os.environ.setdefault("MARKET_PULSE_CACHE", tempfile.mkdtemp(prefix="market-pulse-smoke-"))
+os.environ.setdefault("GMAIL_USER", "smoke@example.com")  # From/To headers only; mail goes to NullSMTP
+os.environ.setdefault("MARKET_PULSE_QUIET_MODE", "full")  # always render the whole briefing
+
+import numpy as np
+import pandas as pd
+
+import super_script as ss
+
+ss.DOWNLOAD_BACKOFF = 0  # injected download failures shouldn't sleep between retries
+
+def fresh_run(providers):
+    """main() on `providers` with an empty cache. Returns (main's result, captured stdout)."""
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = providers
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        result = ss.run_with_report("smoke", ss.main)
+    return result, out.getvalue()
+
+def sent_html(providers):
+    msg = providers.mailbox.sent[-1]
+    return next(p for p in msg.walk() if p.get_content_type() == 'text/html').get_payload(decode=True).decode()
+
+def check_missing_cells():
+    """NaN / None / pd.NA render as n/a, text cells as-is, numbers as before."""
+    series = pd.Series([1.5, np.nan, None, pd.NA, "halted"], dtype=object)
+    cells = ss.format_column(series, 'Day_Chg_Pct')
+    assert [c.split('>')[1].split('<')[0] for c in cells] == ["+1.50%", "n/a", "n/a", "n/a", "halted"], cells
+    cells = ss.format_column(pd.Series([np.nan, 2.0]), 'Price')
+    assert cells[0].endswith(">n/a</td>") and cells[1].endswith(">2.00</td>"), cells
+
+def check_inline_styles():
+    """By default the email keeps its styles inline (clients that drop <head> styles still show
+    green/red cells); MARKET_PULSE_STYLE_CLASSES=1 opts into the <style> block."""
+    result, _ = fresh_run(ss.SyntheticProviders(20))
+    html = sent_html(ss.PROVIDERS)
+    assert result is True and "<style>" not in html and "color:#27ae60" in html, html[:500]
+    saved, ss.EMAIL_STYLE_CLASSES = ss.EMAIL_STYLE_CLASSES, True
+    try:
+        fresh_run(ss.SyntheticProviders(20))
+        assert "<style>" in sent_html(ss.PROVIDERS)
+    finally:
+        ss.EMAIL_STYLE_CLASSES = saved
+
+def check_flat_price_no_benchmark():
+    """A constant-price holding (money-market fund) has no vol or beta, and with SPY missing
+    nothing has a beta: the Risk table shows n/a and the email still goes out."""
+    providers = ss.SyntheticProviders(5)
+    providers.close[:, providers.universe['H00000']] = 1.0
+    del providers.universe[ss.RISK_BENCHMARK]
+    result, out = fresh_run(providers)
+    assert result is True and len(providers.mailbox.sent) == 1, out
+    html = sent_html(providers)
+    assert "Risk (" in html and ">n/a</td>" in html, "risk table missing or NaN cells not shown as n/a"
+
+def check_top_pairs():
+    """With 2 or 3 holdings there are fewer than 5 pairs: no self or mirrored pairs."""
+    rng = np.random.default_rng(0)
+    for k in (2, 3):
+        tickers = [f"T{i}" for i in range(k)]
+        close = pd.DataFrame(100 * np.cumprod(1 + rng.normal(0, 0.02, (64, k)), axis=0), columns=tickers)
+        _, risk = ss.compute_risk(close, tickers, np.ones(k), np.ones(k))
+        pairs = [(a, b) for a, b, _ in risk['top_pairs']]
+        assert len(pairs) == k * (k - 1) // 2, pairs
+        assert all(a != b for a, b in pairs) and len({frozenset(p) for p in pairs}) == len(pairs), pairs
+
+def check_history_step_twice():
+    """`history` run twice inside ARTIFACT_MAX_AGE_MINUTES appends today once, then updates it."""
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = providers = ss.SyntheticProviders(5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ss.run_step("history")
+        ss.run_step("history")
+    writes = [kind for kind, _ in providers.sheet.calls if kind in ('append', 'update')]
+    assert writes == ['append', 'update'], writes
+    dates = [row[0] for row in providers.sheet.tabs['History_Log'][1:]]
+    assert dates.count(ss.today_str()) == 1, dates[-3:]
+
+def check_preview_steps_read_only():
+    """Partial runs that only preview (alerts, ai, chart, render) never write History_Log, even
+    on an empty cache; `send` does, once, and a later `history` doesn't append today again."""
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = providers = ss.SyntheticProviders(5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ss.run_step("chart")
+        ss.run_step("render")
+    writes = [kind for kind, _ in providers.sheet.calls if kind in ('append', 'update')]
+    assert writes == [], providers.sheet.calls
+    with contextlib.redirect_stdout(io.StringIO()):
+        ss.run_step("send")
+        shutil.rmtree(ss.ARTIFACT_DIR)
+        ss.run_step("history")
+    writes = [kind for kind, _ in providers.sheet.calls if kind in ('append', 'update')]
+    assert writes == ['append', 'update'], writes
+    assert len(providers.mailbox.sent) == 1
+    dates = [row[0] for row in providers.sheet.tabs['History_Log'][1:]]
+    assert dates.count(ss.today_str()) == 1, dates[-3:]
+
+class AlertProviders(ss.SyntheticProviders):
+    """Five holdings where today's bar is flat except H00000, which moves `move_pct`;
+    counts Gemini calls."""
+    def __init__(self, move_pct):
+        super().__init__(5)
+        self.generated = 0
+        self.set_move(move_pct)
+
+    def set_move(self, move_pct):
+        self.close[-1] = self.close[-2]
+        self.close[-1, self.universe['H00000']] *= 1 + move_pct / 100
+
+    def generate(self, model, prompt):
+        self.generated += 1
+        return super().generate(model, prompt)
+
+def run_again(providers):
+    """main() on top of whatever the previous run left in the cache (alert state included)."""
+    ss.PROVIDERS = providers
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        result = ss.run_with_report("smoke", ss.main)
+    return result, out.getvalue()
+
+@contextlib.contextmanager
+def quiet_mode(mode):
+    """The production default sends a digest when no new alert fired; smoke otherwise runs 'full'."""
+    saved, ss.QUIET_MODE = ss.QUIET_MODE, mode
+    try:
+        yield
+    finally:
+        ss.QUIET_MODE = saved
+
+def check_quiet_rerun():
+    """The same alerts seen again later in the day: the rerun sends the "(quiet)" digest and
+    never calls Gemini."""
+    with quiet_mode('digest'):
+        providers = AlertProviders(6)
+        result, out = fresh_run(providers)
+        assert result is True and "H00000 +6.0% today" in out, out
+        assert "(quiet)" not in providers.mailbox.sent[-1]['Subject'] and providers.generated == 1
+        os.remove(ss.AI_CACHE_PATH)  # a cache hit must not be what keeps Gemini out
+        result, out = run_again(providers)
+        assert result is True and "No new alerts" in out, out
+        assert "(quiet)" in providers.mailbox.sent[-1]['Subject'], providers.mailbox.sent[-1]['Subject']
+        assert providers.generated == 1, providers.generated
+
+def check_alert_escalation():
+    """A holding that was +6% this morning and is +11% now has crossed twice the threshold:
+    the alert fires again and the full briefing goes out."""
+    with quiet_mode('digest'):
+        providers = AlertProviders(6)
+        fresh_run(providers)
+        providers.set_move(11)
+        result, out = run_again(providers)
+        assert result is True and "H00000 +11.0% today" in out, out
+        assert "(quiet)" not in providers.mailbox.sent[-1]['Subject'] and providers.generated == 2
+
+def check_failed_send_keeps_alerts():
+    """An email that never went out doesn't swallow its alerts: alerts.json is untouched and
+    the next run fires them again."""
+    class Down(ss.NullSMTP):
+        def send_message(self, msg):
+            raise smtplib.SMTPServerDisconnected("connection dropped")
+
+    with quiet_mode('digest'):
+        providers = AlertProviders(6)
+        providers.mailbox = Down()
+        try:
+            fresh_run(providers)
+            raise AssertionError("send failure was swallowed")
+        except smtplib.SMTPServerDisconnected:
+            pass
+        assert not os.path.exists(ss.ALERT_STATE_PATH), open(ss.ALERT_STATE_PATH).read()
+        providers.mailbox = ss.NullSMTP()
+        result, out = run_again(providers)
+        assert result is True and "H00000 +6.0% today" in out, out
+        assert "(quiet)" not in providers.mailbox.sent[-1]['Subject']
+
+def check_truncated_history_state():
+    """A run killed while saving the history mirror's JSON sidecar leaves it truncated; the
+    next run reseeds from the sheet instead of failing before any stage starts."""
+    providers = ss.SyntheticProviders(5)
+    result, _ = fresh_run(providers)
+    assert result is True
+    state_path = ss.HistoryStore.for_sheet(ss.SHEET_NAME).state_path
+    with open(state_path) as f:
+        text = f.read()
+    with open(state_path, 'w') as f:
+        f.write(text[:len(text) // 2])
+    result, out = run_again(providers)
+    assert result is True and "Seeded local history" in out, out
+    with open(state_path) as f:
+        assert json.load(f)['sheet_rows'] == len(providers.sheet.tabs['History_Log']) - 1
+    assert not [n for n in os.listdir(os.path.dirname(state_path)) if n.endswith(".tmp")]
+
+def check_split_restates_cache():
+    """A 4:1 split between runs rescales Yahoo's adjusted history; the cache must be re-downloaded
+    for that ticker instead of mixing old and new scales into a fake -75% day."""
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = providers = ss.SyntheticProviders(5)
+    tickers = list(providers.universe)
+    with contextlib.redirect_stdout(io.StringIO()):
+        before, _ = ss.fetch_market_data(tickers)
+        providers.close[:, providers.universe['H00001']] *= 0.25
+        after, panel = ss.fetch_market_data(tickers)
+    day = dict(zip(after['Ticker'], after['Day_Chg_Pct']))
+    expected = dict(zip(before['Ticker'], before['Day_Chg_Pct']))
+    assert abs(day['H00001'] - expected['H00001']) < 1e-6, (day['H00001'], expected['H00001'])
+    np.testing.assert_allclose(panel['H00001'].to_numpy(), providers.close[:, providers.universe['H00001']])
+
+def check_batch_isolation():
+    """One account's sheet-read error and another's refused recipient don't stop the rest."""
+    class Refusing(ss.NullSMTP):
+        def send_message(self, msg):
+            if msg['To'] == "refused@example.com":
+                raise smtplib.SMTPRecipientsRefused({msg['To']: (550, b"no such user")})
+            super().send_message(msg)
+
+    class Flaky(ss.SyntheticProviders):
+        def open_sheet(self, name):
+            if name == "Broken": raise ConnectionError("sheet unavailable")
+            return super().open_sheet(name)
+
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = providers = Flaky(5)
+    providers.mailbox = Refusing()
+    accounts = [{'sheet': "First", 'recipients': ["refused@example.com"]},
+                {'sheet': "Broken", 'recipients': ["ok@example.com"]},
+                {'sheet': "Last", 'recipients': ["ok@example.com"]}]
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        result = ss.run_batch(accounts)
+    assert result is False, out.getvalue()
+    assert [m['To'] for m in providers.mailbox.sent] == ["ok@example.com"], out.getvalue()
+    assert "First failed at send" in out.getvalue() and "Broken failed at read" in out.getvalue(), out.getvalue()
+
+def check_batch_market_outage():
+    """Yahoo down with a cold cache in batch mode: "Nothing to send" and False, no traceback."""
+    class Down(ss.SyntheticProviders):
+        def download(self, tickers, **kwargs):
+            raise ConnectionError("Yahoo unavailable")
+
+    shutil.rmtree(ss.CACHE_DIR, ignore_errors=True)
+    ss.PROVIDERS = providers = Down(5)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        result = ss.run_batch([{'sheet': "First", 'recipients': ["ok@example.com"]}])
+    assert result is False and "🛑 Nothing to send" in out.getvalue(), out.getvalue()
+    assert providers.mailbox.sent == []
+
+class FaultyDownloads(ss.SyntheticProviders):
+    """Synthetic prices with injected Yahoo faults: the first call for any chunk containing
+    `flaky` raises, `missing` never has data, and outage=True makes every call raise.
+    Each call takes at least `latency` seconds, like a network round trip, so the number of
+    calls in flight at once (peak) reflects the worker pool."""
+    def __init__(self, n, flaky=None, missing=None, outage=False, latency=0.05):
+        super().__init__(n)
+        self.flaky, self.missing, self.outage, self.latency = flaky, missing, outage, latency
+        self.calls, self.in_flight, self.peak = [], 0, 0
+        self._lock = threading.Lock()
+
+    def download(self, tickers, **kwargs):
+        with self._lock:
+            self.calls.append(list(tickers))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if self.outage: raise TimeoutError("Yahoo down")
+            if self.flaky in tickers:
+                self.flaky = None
+                raise ConnectionError("rate limited")
+            data = super().download(tickers, **kwargs)
+            if self.missing in tickers: data.loc[:, self.missing] = np.nan
+            return data
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+def check_download_faults():
+    """Chunks run in parallel (bounded), a chunk that raises once is retried, only failed symbols
+    are re-requested, and a symbol that never arrives is listed in the email, which still goes out."""
+    chunk, workers = ss.DOWNLOAD_CHUNK_SIZE, ss.DOWNLOAD_WORKERS
+    ss.DOWNLOAD_CHUNK_SIZE, ss.DOWNLOAD_WORKERS = 50, 3
+    try:
+        providers = FaultyDownloads(300, flaky='H00120', missing='H00007')
+        result, out = fresh_run(providers)
+    finally:
+        ss.DOWNLOAD_CHUNK_SIZE, ss.DOWNLOAD_WORKERS = chunk, workers
+    assert result is True, out
+    first, retries = providers.calls[:10], providers.calls[10:]  # 300 + 150 watch + SPY + VIX = 452 -> 10 chunks
+    assert all(len(c) <= 50 for c in first) and 1 < providers.peak <= 3, (list(map(len, first)), providers.peak)
+    # Only what failed is re-requested: the chunk that raised once, then the symbol that never arrives
+    # (chunk order follows set() order, so the two may share a chunk)
+    retried = [t for c in retries for t in c]
+    assert set(retried) == set(next(c for c in first if 'H00120' in c)) | {'H00007'}, list(map(len, retries))
+    assert retried.count('H00007') == ss.DOWNLOAD_RETRIES and retries[-1] == ['H00007'], list(map(len, retries))
+    assert all(retried.count(t) == 1 for t in set(retried) - {'H00007'}), "a recovered symbol was re-fetched"
+    assert {t for c in providers.calls for t in c if 'VIX' in t} == {'^VIX'}, "alias not applied at the boundary"
+    html = sent_html(providers)
+    assert "Data issues (1)" in html and "H00007" in html, "missing symbol not reported"
+
+def check_download_outage():
+    """Yahoo fully down: with a warm cache the email goes out on stale prices (and says so);
+    with a cold cache main() returns False, which the CLI turns into a non-zero exit."""
+    providers = ss.SyntheticProviders(5)
+    result, out = fresh_run(providers)
+    assert result is True, out
+    down = FaultyDownloads(5, outage=True)
+    ss.PROVIDERS = down
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        result = ss.run_with_report("smoke", ss.main)
+    assert result is True and "stale, using cached prices" in sent_html(down), out.getvalue()
+
+    result, out = fresh_run(FaultyDownloads(5, outage=True))
+    assert result is False and "Nothing to send" in out, out
+
+def check_replay_leaves_cache_alone():
+    """`--replay` runs the whole briefing from fixtures without touching the real cache dir:
+    no alert state (which would silence the next live run), AI, price or history entries."""
+    fixtures = tempfile.mkdtemp(prefix="market-pulse-fixtures-")
+    providers = ss.SyntheticProviders(20, history_days=300)
+    ranges = [f"'{t}'" for t in ss.SHEET_TABS]
+    with open(os.path.join(fixtures, f"sheet-{ss.SHEET_NAME}.json"), 'w') as f:
+        json.dump({'ranges': ranges, 'response': providers.sheet.values_batch_get(ranges)}, f)
+    providers.download(list(providers.universe), period="3mo").to_pickle(os.path.join(fixtures, "prices.pkl"))
+    with open(os.path.join(fixtures, "ai.json"), 'w') as f:
+        json.dump({'model': ss.AI_MODEL_NAME, 'prompt': "", 'text': "<ul><li>Replayed.</li></ul>"}, f)
+
+    live_cache = tempfile.mkdtemp(prefix="market-pulse-live-")
+    env = {**os.environ, "MARKET_PULSE_CACHE": live_cache}
+    script = os.path.join(os.path.dirname(os.path.abspath(ss.__file__)), "super_script.py")
+    proc = subprocess.run([sys.executable, script, "--quiet-mode", "full", "--replay", fixtures],
+                          env=env, capture_output=True, text=True, timeout=300)
+    assert proc.returncode == 0 and "Done." in proc.stdout, proc.stdout + proc.stderr
+    assert os.listdir(live_cache) == [], os.listdir(live_cache)
+
+def check_stage_memory():
+    """With TRACE_MEMORY each stage reports its own peak: a 64 MB stage shows ~64 MB, a small
+    stage run after it doesn't inherit that, and a full run puts peak_mb on every stage."""
+    def big():
+        block = np.ones(8 * 2**20)  # 64 MB
+        return float(block.sum())
+    def small(_):
+        return sum(range(1000))
+    ss.TRACE_MEMORY = True
+    try:
+        ss.RUN_REPORT = ss.RunReport("smoke")
+        ss.run_stages([ss.Stage("big", big), ss.Stage("small", small, deps=["big"])])
+        peaks = {e['name']: e['peak_mb'] for e in ss.RUN_REPORT.entries}
+        assert 60 <= peaks['stage.big'] <= 70 and peaks['stage.small'] < 1, peaks
+
+        result, _ = fresh_run(ss.SyntheticProviders(20))
+        assert result is True, result
+        stages = [e for e in ss.RUN_REPORT.entries if e['name'].startswith("stage.")]
+        assert stages and all('peak_mb' in e and 'peak_rss_mb' not in e for e in stages), stages
+    finally:
+        ss.TRACE_MEMORY = False
+        ss.tracemalloc.stop()
+
+def check_report_pruning():
+    """Run reports and profiles older than REPORT_MAX_AGE_DAYS are deleted; latest.json,
+    recent reports and anything else in the directory are left alone."""
+    report_dir = tempfile.mkdtemp(prefix="market-pulse-reports-")
+    old = time.time() - (ss.REPORT_MAX_AGE_DAYS + 1) * 86400
+    for name in ("run-old.json", "run-old.prof", "latest.json", "notes.txt", "run-recent.json"):
+        path = os.path.join(report_dir, name)
+        open(path, 'w').close()
+        if name != "run-recent.json": os.utime(path, (old, old))
+    with contextlib.redirect_stdout(io.StringIO()):
+        ss.RunReport("smoke").write(report_dir)
+    left = sorted(n for n in os.listdir(report_dir) if not n.startswith("smoke-"))
+    assert left == ["latest.json", "notes.txt", "run-recent.json"], left
+    assert any(n.startswith("smoke-") for n in os.listdir(report_dir))
+
+def check_network_bytes():
+    """network_bytes counts what went over the wire once: the prompt is counted by the model
+    call that sends it, not again by ai.prompt, which only builds it."""
+    result, _ = fresh_run(ss.SyntheticProviders(20))
+    assert result is True, result
+    report = ss.RUN_REPORT.to_dict()
+    entries = {e['name']: e for e in report['stages']}
+    assert 'bytes' not in entries['ai.prompt'] and entries['ai.prompt']['prompt_bytes'] > 0, entries['ai.prompt']
+    model = entries[f"ai.{ss.AI_MODEL_NAME}"]
+    assert model['bytes'] > entries['ai.prompt']['prompt_bytes'], model  # prompt + answer
+    wire = sum(e.get('bytes', 0) for e in report['stages'] if e['name'] != 'ai.prompt' and e['name'].startswith(ss.NETWORK_STEPS))
+    assert report['network_bytes'] == wire, (report['network_bytes'], wire)
+
+def check_health_server_bind():
+    """The daemon's /health and /metrics listen on loopback unless a host is given."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ss.start_health_server(0)
+    try:
+        assert server.server_address[0] == "127.0.0.1", server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def check_chart_cache_race():
+    """Batch accounts with the same series render the same cached PNG at the same time:
+    every one of them still gets its chart."""
+    dates = np.datetime64('2024-01-02') + np.arange(ss.CHART_POINTS).astype('timedelta64[D]')
+    values = np.linspace(100_000, 130_000, ss.CHART_POINTS)
+    errors = []
+    for _ in range(10):
+        shutil.rmtree(ss.CHART_CACHE_DIR, ignore_errors=True)
+        barrier = threading.Barrier(8)
+        def render():
+            barrier.wait()
+            try:
+                assert set(ss.generate_charts(dates, values, renderer='sparkline')) == set(ss.CHART_SIZES)
+            except Exception as e:
+                errors.append(repr(e))
+        threads = [threading.Thread(target=render) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+    assert not errors, errors[:3]
+    assert not [n for n in os.listdir(ss.CHART_CACHE_DIR) if n.endswith(".tmp")]
+
+CHECKS = {
+    'missing_cells': check_missing_cells,
+    'inline_styles': check_inline_styles,
+    'flat_price_no_benchmark': check_flat_price_no_benchmark,
+    'top_pairs': check_top_pairs,
+    'history_step_twice': check_history_step_twice,
+    'preview_steps_read_only': check_preview_steps_read_only,
+    'quiet_rerun': check_quiet_rerun,
+    'alert_escalation': check_alert_escalation,
+    'failed_send_keeps_alerts': check_failed_send_keeps_alerts,
+    'truncated_history_state': check_truncated_history_state,
+    'split_restates_cache': check_split_restates_cache,
+    'batch_isolation': check_batch_isolation,
+    'batch_market_outage': check_batch_market_outage,
+    'download_faults': check_download_faults,
+    'download_outage': check_download_outage,
+    'replay_leaves_cache_alone': check_replay_leaves_cache_alone,
+    'stage_memory': check_stage_memory,
+    'report_pruning': check_report_pruning,
+    'network_bytes': check_network_bytes,
+    'health_server_bind': check_health_server_bind,
+    'chart_cache_race': check_chart_cache_race,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("checks", nargs="*", help=f"checks to run (default: all of {', '.join(CHECKS)})")
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown: parser.error(f"unknown check(s): {', '.join(sorted(unknown))}")
+
+    failed = []
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name]()
+            print(f"✅ {name}")
+        except Exception:
+            print(f"❌ {name}\n{traceback.format_exc()}")
+            failed.append(name)
+    if failed:
+        print("❌ Failed: " + ", ".join(failed))
+        return 1
+    print("✅ All checks passed.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,124 +5,1256 @@ import json
 import smtplib
 from datetime import datetime
 import pytz 
-import yfinance as yf
 import pandas as pd
-import gspread
-from google import genai
-from google.genai import types
-import matplotlib.pyplot as plt
-from oauth2client.service_account import ServiceAccountCredentials
+import numpy as np
+# yfinance, gspread/oauth2client, google-genai and matplotlib are imported where they're used,
+# so each subcommand only pays for the clients it touches
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
+from email.charset import Charset, QP
 import math
 import io
+import pickle
+import struct
+import zlib
 import re
+import hashlib
+import sqlite3
+import threading
+import sys
+import cProfile
+import pstats
+from contextlib import contextmanager
+from collections import Counter
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import time
+from datetime import timedelta
+import signal
+import tempfile
+import tracemalloc
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pandas.tseries.holiday import (AbstractHolidayCalendar, Holiday, nearest_workday, sunday_to_monday,
+                                    USMartinLutherKingJr, USPresidentsDay, GoodFriday, USMemorialDay,
+                                    USLaborDay, USThanksgivingDay)
+try:
+    import resource  # peak RSS; not available on Windows
+except ImportError:
+    resource = None
 
 # --- CONFIGURATION ---
 SHEET_NAME = "Portfolio_Master_DB"
 AI_MODEL_NAME = 'gemini-2.5-pro' 
+AI_FALLBACK_MODEL = 'gemini-2.5-flash'  # used when the main model blows its latency budget
+AI_LATENCY_BUDGET = 120  # seconds for AI_MODEL_NAME
+AI_FALLBACK_BUDGET = 60  # seconds for AI_FALLBACK_MODEL
+AI_CACHE_TTL_MINUTES = int(os.environ.get("AI_CACHE_TTL_MINUTES", 180))
+AI_MOVE_TOLERANCE_PCT = 1.0  # day/month moves within the same bucket count as "unchanged"
+AI_VALUE_TOLERANCE_PCT = 1.0  # same for net worth, in relative terms
+PROMPT_TOKEN_BUDGET = int(os.environ.get("MARKET_PULSE_PROMPT_TOKENS", 1200))  # whole prompt, estimated below
+PROMPT_CHARS_PER_TOKEN = 4  # rough estimate for English/ticker text; no tokenizer call needed
+PROMPT_GROUP_COLUMNS = ('Sector', 'Theme')  # first of these present in the Portfolio tab buckets the holdings
+PROMPT_SECTION_CANDIDATES = 50  # rows formatted per prompt section before the budget trims them
+OVEREXTENDED_PCT = 20.0  # |monthly move| that counts as overextended
+CACHE_DIR = os.environ.get("MARKET_PULSE_CACHE", ".cache")
+PRICE_CACHE_PATH = os.path.join(CACHE_DIR, "prices.sqlite")
+AI_CACHE_PATH = os.path.join(CACHE_DIR, "ai_insights.json")
+REPORT_DIR = os.path.join(CACHE_DIR, "reports")
+REPORT_MAX_AGE_DAYS = 14  # older run reports and .prof files are deleted (latest.json is kept)
+# Per-stage peak memory via tracemalloc (--trace-memory). Off by default: it makes a run ~2.5x slower.
+TRACE_MEMORY = os.environ.get("MARKET_PULSE_TRACE_MEMORY") == "1"
+PRICE_LOOKBACK_DAYS = 100  # ~3 months of calendar days, enough for the Monthly calc
+PRICE_OVERLAP_DAYS = 7  # warm downloads start this many calendar days before the last cached bar...
+PRICE_RESTATE_TOLERANCE = 0.001  # ...and a completed bar that moved more than this (relative) means a split/dividend
+DOWNLOAD_CHUNK_SIZE = 200  # tickers per provider download call
+DOWNLOAD_WORKERS = 4  # chunks in flight at once; Yahoo throttles well before this matters for small books
+DOWNLOAD_RETRIES = 2  # extra attempts, each re-fetching only the symbols that failed
+DOWNLOAD_BACKOFF = 1.0  # seconds before the first retry, doubled after each
+TICKER_ALIASES = {'.VIX': '^VIX'}  # sheet symbol -> Yahoo symbol; everything but the download uses the sheet one
+# Output column -> lookback in trading bars. Day is required; longer windows fall back to 0.0 when history is short.
+RETURN_WINDOWS = {'Day_Chg_Pct': 1, 'Month_Chg_Pct': 21}
+HISTORY_DIR = os.path.join(CACHE_DIR, "history")
+ROLLING_WINDOWS = (30, 90, 365)  # calendar days
+CHART_POINTS = 30
+CHART_SIZES = {'email': (10, 4, 100), 'mobile': (6, 3.5, 100)}  # name -> (width in, height in, dpi)
+CHART_SIZE = os.environ.get("MARKET_PULSE_CHART_SIZE", "email")  # the one attached to the email
+CHART_RENDERER = os.environ.get("MARKET_PULSE_CHART_RENDERER", "matplotlib")  # or 'sparkline': no matplotlib
+CHART_CACHE_DIR = os.path.join(CACHE_DIR, "charts")
+CHART_CACHE_MAX_AGE_DAYS = 7
+CHART_STYLE_VERSION = 2  # bump when a renderer's look changes, to invalidate cached PNGs
+CHART_PNG_COLORS = 64  # palette size when quantizing chart PNGs (needs Pillow)
+# Gmail clips messages whose HTML is over ~102 KB; tables are cut to the biggest movers until it fits
+EMAIL_HTML_BUDGET = 100_000
+EMAIL_ROW_STEPS = (None, 200, 100, 50, 25, 10)  # table row limits tried in order (None = everything)
+EMAIL_MAX_COMPACTION = 5  # compact_html never shrinks more than this, so bigger drafts skip straight to fewer rows
+# 1 moves repeated inline styles into a <head> <style> block: smaller, so fewer rows get cut, but clients
+# that drop <head> styles (Gmail showing non-Google accounts, some forwards) lose the green/red cells
+EMAIL_STYLE_CLASSES = os.environ.get("MARKET_PULSE_STYLE_CLASSES", "0") == "1"
+RISK_BENCHMARK = 'SPY'  # beta is measured against this; always added to the price fetch
+RISK_LOOKBACK_BARS = 63  # ~3 months of daily returns
+RISK_CORR_MAX_TICKERS = 1000  # the full correlation matrix is N^2 floats; above this only the average is kept
+RISK_TABLE_ROWS = 10
+TRADING_DAYS = 252
+# Alert thresholds. A rule fires again the same day only when it escalates a full step further.
+ALERT_MOVE_PCT = 5.0  # one holding's day move
+ALERT_PORTFOLIO_MOVE_PCT = 2.0  # the whole portfolio's day move
+ALERT_DRAWDOWN_PCT = 10.0  # below the History_Log high-water mark
+ALERT_VIX_LEVEL = 25.0
+ALERT_VIX_JUMP_PCT = 15.0  # VIX day change
+ALERT_REVERSAL_MONTH_PCT = 10.0  # watchlist: month move at least this big...
+ALERT_REVERSAL_DAY_PCT = 3.0  # ...with a day move at least this big the other way
+ALERT_STATE_PATH = os.path.join(CACHE_DIR, "alerts.json")
+VIX_TICKER = '.VIX'  # always fetched, for the VIX rules
+# When no alert fires: 'digest' sends a short email without Gemini or the chart, 'skip' sends nothing,
+# 'full' sends the usual briefing. History_Log is updated either way.
+QUIET_MODE = os.environ.get("MARKET_PULSE_QUIET_MODE", "digest")
+DIGEST_ROWS = 5
+ALERT_DISPLAY_MAX = 20  # alerts listed in the email; the rest are counted
+# Per-stage deadlines (seconds) for the run pipeline in main()
+STAGE_TIMEOUTS = {'sheets': 60, 'market': 180, 'ai': 240, 'chart': 60}
+# Subcommands hand results to each other as pickles here; older ones are rebuilt, not reused
+ARTIFACT_DIR = os.path.join(CACHE_DIR, "artifacts")
+ARTIFACT_MAX_AGE_MINUTES = 30
+# Daemon mode: same slots as the workflow cron, in UTC, NYSE trading days only
+DAEMON_SCHEDULE_UTC = ("14:33", "17:11", "19:55", "21:25")
+DAEMON_PORT = int(os.environ.get("MARKET_PULSE_PORT", 8080))  # /health and /metrics; 0 turns it off
+# /metrics exposes account sizes and errors: loopback only unless you ask (e.g. 0.0.0.0 in a container)
+DAEMON_HOST = os.environ.get("MARKET_PULSE_HOST", "127.0.0.1")
 
-def get_sheet_data():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds = json.loads(os.environ['GCP_SERVICE_ACCOUNT'])
-    client = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(creds, scope))
-    return client.open(SHEET_NAME)
+# --- INSTRUMENTATION ---
+def peak_rss_mb():
+    """Peak RSS of the whole process so far (for a daemon, since it started)."""
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # bytes on macOS, KB on Linux
 
-def fetch_market_data(tickers):
-    if not tickers: return pd.DataFrame()
-    print(f"📡 Fetching data for: {tickers}")
-    try:
-        # Download 3 months to ensure valid Monthly calc
-        data = yf.download(tickers, period="3mo", group_by='ticker', progress=False)
-    except Exception as e:
-        print(f"❌ Yahoo API Error: {e}")
-        return pd.DataFrame()
+NETWORK_STEPS = ("sheets.", "market.download", "ai.", "email.smtp_send")  # entries whose bytes crossed the wire; local-only steps under these prefixes (ai.prompt) must not set bytes
+
+class RunReport:
+    """Timings and counters for one run, written to REPORT_DIR as JSON.
+
+    Entries are flat: pipeline stages (recorded by run_stages) and the helper steps inside
+    them ("market.download", "email.smtp_send", ...). Each carries wall time, status and
+    whatever counters the step set (bytes, rows, tickers). bytes is the decoded payload size,
+    a proxy for what went over the wire. With TRACE_MEMORY, each also gets peak_mb: the highest
+    traced Python/NumPy allocation while it ran, above where it started. Stages run in parallel,
+    so that includes whatever overlapping stages allocated in the same window.
+    """
+    def __init__(self, label="run", profile=False):
+        self.label = label
+        self.profile = profile
+        self.started = datetime.now(pytz.utc)
+        self._t0 = time.perf_counter()
+        self.entries = []
+        self._profiles = []
+        self._lock = threading.Lock()
+        self.memory = TRACE_MEMORY
+        self._spans = {}  # memory_span() in flight -> [traced bytes at start, highest seen]
+        if self.memory and not tracemalloc.is_tracing(): tracemalloc.start()
 
-    results = []
-    for ticker in tickers:
+    def record(self, name, wall_s, status='ok', **metrics):
+        entry = {'name': name, 'start_s': round(time.perf_counter() - self._t0 - wall_s, 3),
+                 'wall_s': round(wall_s, 4), 'status': status, **metrics}
+        with self._lock:
+            self.entries.append(entry)
+
+    def _fold_peak(self):
+        """Credit the traced peak since the last call to every open span, then reset it.
+        Called under the lock at every span start and end, so each span sees the peak of
+        exactly its own window. Returns the bytes traced right now."""
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for span in self._spans.values():
+            span[1] = max(span[1], peak)
+        return current
+
+    @contextmanager
+    def memory_span(self):
+        """`with RUN_REPORT.memory_span() as mem:` sets mem['peak_mb'] when TRACE_MEMORY is on."""
+        mem = {}
+        if not self.memory or not tracemalloc.is_tracing():
+            yield mem
+            return
+        key = object()
+        with self._lock:
+            start = self._fold_peak()
+            self._spans[key] = [start, start]
         try:
-            hist = data[ticker] if len(tickers) > 1 else data
-            hist = hist.dropna(subset=['Close'])
-            if hist.empty: continue
-
-            current = float(hist['Close'].iloc[-1])
-            prev = float(hist['Close'].iloc[-2])
-            day_pct = ((current - prev) / prev) * 100
-            
-            # Monthly Calc (Approx 21 trading days)
-            if len(hist) >= 22:
-                month_start = float(hist['Close'].iloc[-22])
-                month_pct = ((current - month_start) / month_start) * 100
-            else:
-                month_pct = 0.0
-
-            results.append({
-                "Ticker": ticker,
-                "Price": current,
-                "Day_Chg_Pct": day_pct,
-                "Month_Chg_Pct": month_pct
-            })
-        except:
-            continue
-    return pd.DataFrame(results)
+            yield mem
+        finally:
+            with self._lock:
+                self._fold_peak()
+                start, peak = self._spans.pop(key)
+            mem['peak_mb'] = round((peak - start) / 2**20, 1)
+
+    @contextmanager
+    def timed(self, name, **metrics):
+        """`with RUN_REPORT.timed("step") as m: ...; m['rows'] = n`"""
+        m = dict(metrics)
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            with self.memory_span() as mem:
+                yield m
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, status, **m, **mem)
 
-def get_ai_insights(port_df, watch_df, total_val, day_gain_dollar):
+    def profiled(self, fn):
+        """Wrap fn so it runs under its own cProfile when --profile is on. Used per stage thread."""
+        if not self.profile: return fn
+        def wrapper(*args):
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                return fn(*args)  # 3.12+: the run-level profiler already covers every thread
+            try:
+                return fn(*args)
+            finally:
+                prof.disable()
+                with self._lock:
+                    self._profiles.append(prof)
+        return wrapper
+
+    def to_dict(self):
+        with self._lock:
+            entries = sorted(self.entries, key=lambda e: e['start_s'])
+        return {
+            'label': self.label,
+            'started': self.started.isoformat(),
+            'wall_s': round(time.perf_counter() - self._t0, 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'network_bytes': sum(e.get('bytes', 0) for e in entries if e['name'].startswith(NETWORK_STEPS)),
+            'stages': entries,
+        }
+
+    def write(self, report_dir=None):
+        report_dir = report_dir or REPORT_DIR
+        os.makedirs(report_dir, exist_ok=True)
+        stamp = self.started.strftime("%Y%m%dT%H%M%SZ")
+        data = self.to_dict()
+        for name in (f"{self.label}-{stamp}.json", "latest.json"):
+            with open(os.path.join(report_dir, name), 'w') as f:
+                json.dump(data, f, indent=1)
+        print(f"📊 Run report: {os.path.join(report_dir, f'{self.label}-{stamp}.json')} ({data['wall_s']:.1f}s)")
+        if self._profiles:
+            stats = pstats.Stats(self._profiles[0])
+            for prof in self._profiles[1:]:
+                stats.add(prof)
+            prof_path = os.path.join(report_dir, f"{self.label}-{stamp}.prof")
+            stats.dump_stats(prof_path)
+            print(f"🔬 Profile: {prof_path} (open with snakeviz / flameprof)")
+        prune_reports(report_dir)
+        return data
+
+def prune_reports(report_dir):
+    cutoff = time.time() - REPORT_MAX_AGE_DAYS * 86400
+    for name in os.listdir(report_dir):
+        if name == "latest.json" or not name.endswith((".json", ".prof")): continue
+        path = os.path.join(report_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff: os.remove(path)
+        except OSError:
+            pass  # another run got there first
+
+RUN_REPORT = RunReport()
+
+def run_with_report(label, fn, *args, profile=False):
+    """Run fn(*args) under a fresh RUN_REPORT and always write the report, even on failure."""
+    global RUN_REPORT
+    RUN_REPORT = RunReport(label, profile=profile)
     try:
-        print(f"🧠 Asking {AI_MODEL_NAME}...")
-        client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
-        
-        port_sorted = port_df.reindex(port_df.Day_Chg_Pct.abs().sort_values(ascending=False).index)
-        watch_sorted = watch_df.reindex(watch_df.Day_Chg_Pct.abs().sort_values(ascending=False).index)
-        
-        p_str = port_sorted[['Ticker', 'Day_Chg_Pct', 'Month_Chg_Pct', 'Total_Gain_Loss']].head(15).to_string(index=False)
-        w_str = watch_sorted[['Ticker', 'Day_Chg_Pct', 'Month_Chg_Pct']].head(15).to_string(index=False)
-        
-        prompt = f"""
-        You are a Hedge Fund CIO.
-        **STATUS:** Net Worth: ${total_val:,.0f} | Today's Move: ${day_gain_dollar:,.0f}
-        **HOLDINGS:**
-        {p_str}
-        **WATCHLIST:**
-        {w_str}
-        
-        **TASK:** Write a 3-bullet executive summary in pure HTML (no markdown code blocks).
-        
-        1. <b>The Why:</b> Analyze drivers (Macro vs Company).
-        2. <b>The Risk:</b> Identify overextended positions (>20% Monthly).
-        3. <b>The Hunt:</b> Flag Reversal setups in Watchlist.
-        
-        **CRITICAL:** End your response with a section titled "<br><b>🔗 Sources:</b>" followed by an HTML unordered list (<ul>) containing 1-2 direct links (<a href='...'>Article Title</a>) to the news used.
-        """
-        
-        response = client.models.generate_content(
-            model=AI_MODEL_NAME,
+        return RUN_REPORT.profiled(fn)(*args)
+    finally:
+        RUN_REPORT.write()
+
+def get_sheet_data(sheet_name=SHEET_NAME):
+    return PROVIDERS.open_sheet(sheet_name)
+
+SHEET_TABS = ["Portfolio", "Watchlist", "History_Log"]
+
+def values_to_records(values):
+    """Same shape as Worksheet.get_all_records(): header row -> list of dicts, numbers parsed."""
+    if not values: return []
+    import gspread
+    headers = values[0]
+    rows = gspread.utils.fill_gaps(values[1:], cols=len(headers)) if len(values) > 1 else []
+    return gspread.utils.to_records(headers, [gspread.utils.numericise_all(r) for r in rows])
+
+class SheetStore:
+    """All Sheets I/O for one workbook: one batch_get for every tab, then History_Log is kept
+    in memory with a Date -> row index so upserts never re-read or scan the sheet."""
+    def __init__(self, backend):
+        self.backend = backend  # gspread.Spreadsheet, or FakeSpreadsheet offline
+        self.records = {}
+        self.history_index = {}
+
+    def load(self, tabs=SHEET_TABS):
+        import gspread
+        with RUN_REPORT.timed("sheets.batch_get") as m:
+            resp = self.backend.values_batch_get([gspread.utils.absolute_range_name(t) for t in tabs])
+            for tab, value_range in zip(tabs, resp.get('valueRanges', [])):
+                self.records[tab] = values_to_records(value_range.get('values', []))
+            m['rows'] = sum(len(r) for r in self.records.values())
+            m['bytes'] = len(json.dumps(resp, default=str))
+        return self.restore(self.records)
+
+    def restore(self, records):
+        """Adopt already-read records and rebuild the History_Log row index."""
+        self.records = records
+        # Row number = list position + 2 (1 for header, 1 for 0-index)
+        self.history_index = {str(r['Date']): i + 2 for i, r in enumerate(self.history)}
+        return self.records
+
+    @property
+    def history(self):
+        return self.records.setdefault("History_Log", [])
+
+    def upsert_history(self, today, total_val, total_gain_loss):
+        row = [today, float(total_val), float(total_gain_loss)]
+        record = dict(zip(['Date', 'Total_Value', 'Total_Gain_Loss'], row))
+        with RUN_REPORT.timed("sheets.upsert_history", rows=1):
+            self._upsert(today, row, record)
+
+    def _upsert(self, today, row, record):
+        import gspread
+        row_idx = self.history_index.get(today)
+        if row_idx:
+            self.backend.values_update(
+                gspread.utils.absolute_range_name("History_Log", f"A{row_idx}:C{row_idx}"),
+                params={'valueInputOption': 'RAW'}, body={'values': [row]})
+            self.history[row_idx - 2] = record
+            print(f"📝 Updated existing row for {today}")
+        else:
+            resp = self.backend.values_append(
+                gspread.utils.absolute_range_name("History_Log", "A1"),
+                params={'valueInputOption': 'RAW'}, body={'values': [row]})
+            updated = re.search(r'!A(\d+)', resp.get('updates', {}).get('updatedRange', ''))
+            self.history.append(record)
+            self.history_index[today] = int(updated.group(1)) if updated else len(self.history) + 1
+            print(f"📝 Added new row for {today}")
+
+class FakeSpreadsheet:
+    """In-process stand-in for gspread.Spreadsheet (just the calls SheetStore makes), so the
+    Sheets layer can be exercised and benchmarked without credentials. Tabs are lists of rows."""
+    def __init__(self, tabs=None):
+        self.tabs = {name: [list(r) for r in rows] for name, rows in (tabs or {}).items()}
+        self.calls = []
+
+    def _parse(self, range_name):
+        m = re.match(r"'((?:[^']|'')*)'(?:!([A-Z]+)(\d+)(?::[A-Z]+\d+)?)?$", range_name)
+        return m.group(1).replace("''", "'"), int(m.group(3)) if m.group(3) else None
+
+    def values_batch_get(self, ranges, params=None):
+        self.calls.append(('batch_get', len(ranges)))
+        return {'valueRanges': [{'range': r, 'values': [list(row) for row in self.tabs.get(self._parse(r)[0], [])]} for r in ranges]}
+
+    def values_update(self, range_name, params=None, body=None):
+        self.calls.append(('update', range_name))
+        tab, row = self._parse(range_name)
+        self.tabs[tab][row - 1] = list(body['values'][0])
+        return {'updatedRange': range_name}
+
+    def values_append(self, range_name, params=None, body=None):
+        self.calls.append(('append', range_name))
+        tab, _ = self._parse(range_name)
+        self.tabs.setdefault(tab, []).extend(list(r) for r in body['values'])
+        n = len(self.tabs[tab])
+        return {'updates': {'updatedRange': f"'{tab}'!A{n}:C{n}"}}
+
+# --- PROVIDERS ---
+# Every external call goes through PROVIDERS, so a run can be pointed at recorded fixtures
+# or synthetic data instead of Google Sheets / Yahoo / Gemini / Gmail.
+class LiveProviders:
+    """The real services."""
+    def __init__(self):
+        self._sheets_client = None
+        self._spreadsheets = {}
+        self._lock = threading.Lock()
+
+    def open_sheet(self, name):
+        with self._lock:
+            if self._sheets_client is None:  # authorize once, reuse for every workbook
+                import gspread
+                from oauth2client.service_account import ServiceAccountCredentials
+                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+                creds = json.loads(os.environ['GCP_SERVICE_ACCOUNT'])
+                self._sheets_client = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(creds, scope))
+            if name not in self._spreadsheets:  # open() is a Drive lookup; the handle stays valid
+                self._spreadsheets[name] = self._sheets_client.open(name)
+            return self._spreadsheets[name]
+
+    def download(self, tickers, **kwargs):
+        """yf.download(group_by='ticker') for `tickers`; kwargs are period= or start=."""
+        import yfinance as yf
+        return yf.download(tickers, group_by='ticker', progress=False, **kwargs)
+
+    def generate(self, model, prompt):
+        from google.genai import types
+        return get_genai_client().models.generate_content(
+            model=model,
             contents=prompt,
             config=types.GenerateContentConfig(
                 tools=[types.Tool(google_search=types.GoogleSearch())]
             )
-        )
+        ).text
+
+    def smtp(self):
+        s = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+        s.login(os.environ["GMAIL_USER"], os.environ["GMAIL_PASS"])
+        return s
+
+    def warm_up(self, sheet_names):
+        """Daemon start: authorize Sheets and build the Gemini client."""
+        for name in sheet_names:
+            self.open_sheet(name)
+        get_genai_client()
+
+class NullSMTP:
+    """SMTP stand-in that keeps sent messages in memory."""
+    def __init__(self):
+        self.sent = []
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+class SyntheticProviders(LiveProviders):
+    """Generated portfolio of `n_holdings` tickers (plus a watchlist), `history_days` of
+    History_Log and deterministic random-walk prices. `ai_latency` simulates Gemini."""
+    def __init__(self, n_holdings, n_watch=None, history_days=3 * 252, ai_latency=0.0, seed=0):
+        super().__init__()
+        rng = np.random.default_rng(seed)
+        n_watch = n_holdings // 2 if n_watch is None else n_watch
+        holdings = [f"H{i:05d}" for i in range(n_holdings)]
+        watch = [f"W{i:05d}" for i in range(n_watch)]
+        self.universe = {t: i for i, t in enumerate(holdings + watch + [RISK_BENCHMARK, TICKER_ALIASES[VIX_TICKER]])}
+
+        self.dates = pd.bdate_range(end=pd.Timestamp(today_str()), periods=63)
+        steps = rng.normal(0.0005, 0.02, (len(self.dates), len(self.universe)))
+        self.close = rng.uniform(5, 500, len(self.universe)) * np.cumprod(1 + steps, axis=0)
+
+        hist_dates = pd.bdate_range(end=pd.Timestamp(today_str()) - pd.Timedelta(days=1), periods=history_days)
+        hist_vals = 1e6 * np.cumprod(1 + rng.normal(0.0003, 0.01, history_days))
+        self.sheet = FakeSpreadsheet({
+            'Portfolio': [['Ticker', 'Shares', 'Cost Basis']] + [
+                [t, int(sh), round(float(cb), 2)] for t, sh, cb in zip(holdings, rng.integers(1, 500, n_holdings), rng.uniform(5, 500, n_holdings))],
+            'Watchlist': [['Ticker']] + [[t] for t in watch],
+            'History_Log': [['Date', 'Total_Value', 'Total_Gain_Loss']] + [
+                [d.strftime("%Y-%m-%d"), round(float(v), 2), round(float(v) * 0.1, 2)] for d, v in zip(hist_dates, hist_vals)],
+        })
+        self.ai_latency = ai_latency
+        self.mailbox = NullSMTP()
+
+    def open_sheet(self, name):
+        return self.sheet
+
+    def download(self, tickers, period=None, start=None, **kwargs):
+        rows = self.dates >= pd.Timestamp(start) if start else np.ones(len(self.dates), dtype=bool)
+        cols = np.array([self.universe.get(t, -1) for t in tickers])
+        close = np.where(cols >= 0, self.close[rows][:, np.clip(cols, 0, None)], np.nan)
+        fields = ['Open', 'High', 'Low', 'Close', 'Volume']
+        block = np.stack([close, close * 1.01, close * 0.99, close, np.full_like(close, 1e6)], axis=2)
+        return pd.DataFrame(block.reshape(len(close), -1), index=self.dates[rows],
+                            columns=pd.MultiIndex.from_product([tickers, fields]))
+
+    def generate(self, model, prompt):
+        time.sleep(self.ai_latency)
+        return "<ul><li><b>The Why:</b> Synthetic run.</li></ul><br><b>🔗 Sources:</b><ul><li>n/a</li></ul>"
+
+    def smtp(self):
+        return self.mailbox
+
+    def warm_up(self, sheet_names):
+        for name in sheet_names:
+            self.open_sheet(name)
+
+class RecordingSheet:
+    """Proxy for a live gspread.Spreadsheet that saves every batch read to `path`."""
+    def __init__(self, sheet, path):
+        self.sheet = sheet
+        self.path = path
+
+    def values_batch_get(self, ranges, params=None):
+        resp = self.sheet.values_batch_get(ranges, params=params)
+        with open(self.path, 'w') as f:
+            json.dump({'ranges': ranges, 'response': resp}, f)
+        return resp
+
+    def __getattr__(self, name):
+        return getattr(self.sheet, name)
+
+class RecordingProviders(LiveProviders):
+    """Live services, with every sheet read, price download and AI answer saved to `fixture_dir`
+    for ReplayProviders. Writes and emails still go to the real services."""
+    def __init__(self, fixture_dir):
+        super().__init__()
+        self.fixture_dir = fixture_dir
+        os.makedirs(fixture_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.fixture_dir, name)
+
+    def open_sheet(self, name):
+        slug = re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+        return RecordingSheet(super().open_sheet(name), self._path(f"sheet-{slug}.json"))
+
+    def download(self, tickers, **kwargs):
+        data = super().download(tickers, **kwargs)
+        with self._lock:
+            path = self._path("prices.pkl")
+            if os.path.exists(path):
+                old = pd.read_pickle(path)
+                data = data.combine_first(old) if data is not None else old
+            if data is not None: data.to_pickle(path)
+        return data
+
+    def generate(self, model, prompt):
+        text = super().generate(model, prompt)
+        with self._lock:
+            with open(self._path("ai.json"), 'w') as f:
+                json.dump({'model': model, 'prompt': prompt, 'text': text}, f)
+        return text
+
+class ReplayProviders(LiveProviders):
+    """Serves what RecordingProviders captured. Sheet writes land in memory, emails in `mailbox`.
+    --replay also points the local caches at a temp dir (set_cache_dir), so a replay can't mark
+    today's alerts as sent or leave AI, price or history entries behind for the next live run."""
+    def __init__(self, fixture_dir):
+        super().__init__()
+        self.fixture_dir = fixture_dir
+        self.sheets = {}
+        self.mailbox = NullSMTP()
+
+    def open_sheet(self, name):
+        with self._lock:
+            if name not in self.sheets:
+                slug = re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+                with open(os.path.join(self.fixture_dir, f"sheet-{slug}.json")) as f:
+                    recorded = json.load(f)
+                # Requested ranges are whole tabs ("'History_Log'"), in the same order as the response
+                titles = [r.strip("'").replace("''", "'") for r in recorded['ranges']]
+                self.sheets[name] = FakeSpreadsheet({
+                    title: vr.get('values', []) for title, vr in zip(titles, recorded['response'].get('valueRanges', []))})
+            return self.sheets[name]
+
+    def download(self, tickers, period=None, start=None, **kwargs):
+        data = pd.read_pickle(os.path.join(self.fixture_dir, "prices.pkl"))
+        data = data.loc[:, data.columns.get_level_values(0).isin(tickers)]
+        return data[data.index >= pd.Timestamp(start)] if start else data
+
+    def generate(self, model, prompt):
+        with open(os.path.join(self.fixture_dir, "ai.json")) as f:
+            return json.load(f)['text']
+
+    def smtp(self):
+        return self.mailbox
+
+    def warm_up(self, sheet_names):
+        for name in sheet_names:
+            self.open_sheet(name)
+
+PROVIDERS = LiveProviders()
+
+def set_cache_dir(path):
+    """Move every local cache (prices, AI, alerts, history mirror, charts, artifacts, reports) under `path`."""
+    global CACHE_DIR, PRICE_CACHE_PATH, AI_CACHE_PATH, REPORT_DIR, HISTORY_DIR, CHART_CACHE_DIR, ALERT_STATE_PATH, ARTIFACT_DIR
+    CACHE_DIR = path
+    PRICE_CACHE_PATH = os.path.join(path, "prices.sqlite")
+    AI_CACHE_PATH = os.path.join(path, "ai_insights.json")
+    REPORT_DIR = os.path.join(path, "reports")
+    HISTORY_DIR = os.path.join(path, "history")
+    CHART_CACHE_DIR = os.path.join(path, "charts")
+    ALERT_STATE_PATH = os.path.join(path, "alerts.json")
+    ARTIFACT_DIR = os.path.join(path, "artifacts")
+
+def open_price_cache(path=None, **kwargs):
+    path = path or PRICE_CACHE_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS prices (
+            ticker TEXT NOT NULL, date TEXT NOT NULL,
+            open REAL, high REAL, low REAL, close REAL, volume REAL,
+            PRIMARY KEY (ticker, date)
+        )""")
+    return conn
+
+def store_bars(conn, data, tickers):
+    """Upsert a yf.download(group_by='ticker') frame into the cache. Re-fetched dates overwrite the old bar."""
+    fields = ['Open', 'High', 'Low', 'Close', 'Volume']
+    present = set(data.columns.get_level_values(0))
+    tickers = [t for t in tickers if t in present]
+    if not tickers: return 0
+    # (date, ticker, field) block, then keep every (date, ticker) cell that has a Close
+    block = data.reindex(columns=pd.MultiIndex.from_product([tickers, fields])).to_numpy(dtype=float)
+    block = block.reshape(len(data), len(tickers), len(fields))
+    d_idx, t_idx = np.nonzero(~np.isnan(block[:, :, 3]))
+    bars = block[d_idx, t_idx]
+    dates = np.asarray(data.index.strftime("%Y-%m-%d"))
+    # NaN binds as NULL in SQLite
+    rows = list(zip(np.asarray(tickers, dtype=object)[t_idx].tolist(), dates[d_idx].tolist(), *bars.T.tolist()))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+def download_chunk(symbols, **kwargs):
+    """One provider call. Returns (frame or None, {symbol: reason}) for symbols with no Close."""
+    try:
+        with RUN_REPORT.timed("market.download", tickers=len(symbols)) as m:
+            data = PROVIDERS.download(symbols, **kwargs)
+            m['bytes'] = int(data.size) * 8 if data is not None else 0  # float64 cells; memory_usage() walks every column
+    except Exception as e:
+        return None, {t: f"{type(e).__name__}: {e}" for t in symbols}
+    if data is None or data.empty:
+        return None, {t: "no data returned" for t in symbols}
+    if not isinstance(data.columns, pd.MultiIndex):
+        data.columns = pd.MultiIndex.from_product([symbols, data.columns])
+    close = data.xs('Close', axis=1, level=1).reindex(columns=symbols).to_numpy(dtype=float)
+    failed = {t: "no data returned" for t, miss in zip(symbols, np.isnan(close).all(axis=0)) if miss}
+    if failed:  # drop their all-NaN blocks so a successful retry doesn't collide with them
+        data = data.loc[:, ~data.columns.get_level_values(0).isin(list(failed))]
+    return data, failed
+
+def download_chunked(tickers, **kwargs):
+    """PROVIDERS.download for any number of tickers: DOWNLOAD_CHUNK_SIZE per call, DOWNLOAD_WORKERS
+    calls at a time, and up to DOWNLOAD_RETRIES retries (with backoff) of just the symbols that
+    errored or came back empty. Tickers are sheet symbols; TICKER_ALIASES is applied here only.
+    Returns (frame keyed by sheet symbol, {ticker: reason} for what never arrived)."""
+    to_yahoo = {t: TICKER_ALIASES.get(t, t) for t in tickers}
+    to_sheet = {y: t for t, y in to_yahoo.items()}
+    pending, frames, failed = list(to_yahoo.values()), [], {}
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if attempt:
+            delay = DOWNLOAD_BACKOFF * 2 ** (attempt - 1)
+            print(f"🔁 Retrying {len(pending)} symbol(s) in {delay:.0f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+        chunks = [pending[i:i + DOWNLOAD_CHUNK_SIZE] for i in range(0, len(pending), DOWNLOAD_CHUNK_SIZE)]
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_WORKERS, len(chunks)))) as pool:
+            results = list(pool.map(lambda c: download_chunk(c, **kwargs), chunks))
+        failed = {}
+        for data, chunk_failed in results:
+            if data is not None: frames.append(data)
+            failed.update(chunk_failed)
+        pending = list(failed)
+        if not pending: break
+
+    failures = {to_sheet[y]: reason for y, reason in failed.items()}
+    if not frames: return pd.DataFrame(), failures
+    data = pd.concat(frames, axis=1) if len(frames) > 1 else frames[0]
+    aliased = {y: t for y, t in to_sheet.items() if y != t}
+    if aliased: data = data.rename(columns=aliased, level=0)
+    return data, failures
+
+def restated_tickers(conn, data, last):
+    """Tickers whose latest completed bar before their last cached date no longer matches the cache.
+    Yahoo closes are split/dividend adjusted, so a corporate action rescales the whole history and
+    appending new bars to the old ones would mix the two scales."""
+    close = data.xs('Close', axis=1, level=1)
+    tickers = close.columns.to_numpy(dtype=object)
+    values = close.to_numpy(dtype=float)
+    dates = np.asarray(close.index.strftime("%Y-%m-%d"))
+    completed = ~np.isnan(values) & (dates[:, None] < np.array([last[t] for t in tickers])[None, :])
+    has = completed.any(axis=0)
+    row = len(dates) - 1 - np.argmax(completed[::-1], axis=0)  # last completed bar per ticker
+    cols = np.flatnonzero(has)
+    if not len(cols): return []
+    probe = list(zip(tickers[cols].tolist(), dates[row[cols]].tolist(), values[row[cols], cols].tolist()))
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS overlap_probe (ticker TEXT, date TEXT, close REAL)")
+    with conn:
+        conn.execute("DELETE FROM overlap_probe")
+        conn.executemany("INSERT INTO overlap_probe VALUES (?, ?, ?)", probe)
+    rows = conn.execute("""
+        SELECT o.ticker FROM overlap_probe o JOIN prices p ON p.ticker = o.ticker AND p.date = o.date
+        WHERE ABS(o.close / p.close - 1) > ?""", (PRICE_RESTATE_TOLERANCE,)).fetchall()
+    return [t for (t,) in rows]
+
+def update_price_cache(conn, tickers):
+    """Download only the bars each ticker is missing, plus PRICE_OVERLAP_DAYS of overlap: the last
+    cached bar is re-fetched so a partial intraday bar gets replaced by the latest print, and a
+    completed bar is compared with the cache so a split or dividend triggers a full re-download.
+    Returns (the start date of every batch that was written, None for a cold full-history batch;
+    {ticker: reason} for tickers whose download failed, whose cached bars are now stale or absent)."""
+    cutoff = (datetime.now() - timedelta(days=PRICE_LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+    with conn:
+        conn.execute("DELETE FROM prices WHERE date < ?", (cutoff,))
+    last = dict(conn.execute("SELECT ticker, MAX(date) FROM prices GROUP BY ticker"))
+
+    batches = {}
+    for t in tickers:
+        start = last.get(t)
+        key = start if start and start >= cutoff else None  # None = cold ticker, full history
+        batches.setdefault(key, []).append(t)
+
+    written, failures, restated = [], {}, []
+    def fetch(group, start):
+        data, failed = download_chunked(group, **({'period': "3mo"} if start is None else {'start': start}))
+        if failed:
+            failures.update(failed)
+            print(f"❌ Yahoo download failed for {len(failed)}/{len(group)} tickers from {start or '3mo'}: "
+                  + ", ".join(f"{t} ({r})" for t, r in list(failed.items())[:5]) + (" ..." if len(failed) > 5 else ""))
+        if data.empty: return
+        group = [t for t in group if t not in failed]
+        if start is not None:
+            with RUN_REPORT.timed("market.overlap_check", tickers=len(group)) as m:
+                changed = restated_tickers(conn, data, last)
+                m['rows'] = len(changed)
+            restated.extend(changed)
+        with RUN_REPORT.timed("market.cache_write", tickers=len(group)) as m:
+            n = m['rows'] = store_bars(conn, data, group)
+        written.append(start)
+        print(f"💾 Cached {n} bars for {len(group)} tickers (since {start or '3mo'})")
+
+    for last_date, group in sorted(batches.items(), key=lambda kv: kv[0] or ""):
+        start = None if last_date is None else (pd.Timestamp(last_date) - pd.Timedelta(days=PRICE_OVERLAP_DAYS)).strftime("%Y-%m-%d")
+        fetch(group, start)
+
+    if restated:
+        print(f"🔀 History restated for {len(restated)} ticker(s) (split/dividend?): {', '.join(restated[:10])}"
+              + (" ..." if len(restated) > 10 else "") + ". Re-downloading 3mo.")
+        with conn:
+            conn.executemany("DELETE FROM prices WHERE ticker = ?", [(t,) for t in restated])
+        fetch(restated, None)
+    return written, failures
+
+def load_close_panel(conn, tickers=None, since=None):
+    """Wide Close panel (date x ticker) for the lookback window, read straight from the cache.
+    tickers=None keeps every cached ticker; `since` narrows the read to recent bars."""
+    cutoff = (datetime.now() - timedelta(days=PRICE_LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+    rows = pd.read_sql_query("SELECT ticker, date, close FROM prices WHERE date >= ?", conn, params=(max(cutoff, since or ""),))
+    if tickers is not None: rows = rows[rows['ticker'].isin(tickers)]
+    panel = rows.pivot(index='date', columns='ticker', values='close')
+    panel.index = pd.to_datetime(panel.index)
+    return panel.sort_index()
+
+# Set by keep_price_cache_open() in daemon mode: one connection for every run, plus the Close
+# panel of every cached ticker so a warm run only re-reads the bars it just downloaded
+_resident_price_cache = None
+_resident_panel = None
+_resident_price_lock = threading.Lock()
+
+def keep_price_cache_open(cache_mb=256):
+    global _resident_price_cache
+    conn = open_price_cache(check_same_thread=False)  # stage threads differ from run to run
+    conn.execute(f"PRAGMA cache_size = -{cache_mb * 1024}")  # negative = KiB; keeps hot bars in RAM
+    _resident_price_cache = conn
+
+@contextmanager
+def price_cache():
+    if _resident_price_cache is not None:
+        with _resident_price_lock:
+            yield _resident_price_cache
+        return
+    conn = open_price_cache()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def resident_close_panel(conn, tickers, written):
+    """Patch the in-memory panel with what update_price_cache just wrote. Only valid while this
+    process is the cache's sole writer, which is what daemon mode assumes."""
+    global _resident_panel
+    panel = _resident_panel
+    if panel is None or None in written or not set(tickers) <= set(panel.columns):
+        panel = load_close_panel(conn)
+    elif written:
+        since = min(written)
+        cutoff = pd.Timestamp(datetime.now() - timedelta(days=PRICE_LOOKBACK_DAYS)).normalize()
+        recent = load_close_panel(conn, since=since)
+        panel = pd.concat([panel[(panel.index >= cutoff) & (panel.index < pd.Timestamp(since))], recent]).sort_index()
+    _resident_panel = panel
+    return panel.loc[:, panel.columns.isin(tickers)].dropna(how='all')
+
+def fetch_close_panel(tickers):
+    """(Close panel, {ticker: reason} for failed downloads)."""
+    with price_cache() as conn:
+        written, failures = update_price_cache(conn, tickers)
+        with RUN_REPORT.timed("market.cache_read", tickers=len(tickers)) as m:
+            if conn is _resident_price_cache:
+                panel = resident_close_panel(conn, tickers, written)
+            else:
+                panel = load_close_panel(conn, tickers)
+            m['rows'] = int(panel.size)
+        return panel, failures
+
+def compute_returns(close, tickers, windows=RETURN_WINDOWS):
+    """Batched N-bar returns for every ticker in a wide Close panel (date x ticker).
+
+    Each column is packed so its valid bars sit at the bottom in date order, which lets
+    one fancy-index pull the k-th last *valid* bar for all tickers at once, even when
+    tickers stop on different dates. Returns (DataFrame, {ticker: reason}) for dropped tickers.
+    """
+    close = close.reindex(columns=tickers)
+    values = close.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=0)
+
+    # Stable sort on the mask moves NaNs to the top without reordering the real bars
+    order = np.argsort(valid, axis=0, kind='stable')
+    packed = np.take_along_axis(values, order, axis=0)
+    cols = np.arange(values.shape[1])
+    n_rows = values.shape[0]
+
+    def bar_back(k):
+        idx = np.clip(n_rows - 1 - k, 0, None)
+        out = packed[idx, cols] if n_rows else np.full(len(cols), np.nan)
+        return np.where(counts > k, out, np.nan)
+
+    current = bar_back(0)
+    out = {"Ticker": np.asarray(tickers, dtype=object), "Price": current}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col, k in windows.items():
+            base = bar_back(k)
+            pct = (current - base) / base * 100
+            out[col] = pct if k == 1 else np.where(np.isfinite(pct), pct, 0.0)
+
+    dropped = {}
+    day = out['Day_Chg_Pct']
+    reasons = np.select(
+        [counts == 0, counts < 2, ~np.isfinite(day)],
+        ["no price data", "only one bar", "zero previous close"],
+        default="",
+    )
+    for ticker, reason in zip(tickers, reasons):
+        if reason: dropped[ticker] = str(reason)
+
+    df = pd.DataFrame(out)
+    return df[reasons == ""].reset_index(drop=True), dropped
+
+def fetch_market_data(tickers):
+    """(returns table, Close panel) for `tickers`. The table's attrs['issues'] maps each ticker
+    that failed to download or was dropped to a reason, for the email."""
+    if not tickers: return pd.DataFrame(), pd.DataFrame()
+    shown = tickers if len(tickers) <= 30 else tickers[:30] + [f"... +{len(tickers) - 30} more"]
+    print(f"📡 Fetching data for: {shown}")
+    data, failures = fetch_close_panel(tickers)
+    if data.empty:
+        print("❌ No price data available (Yahoo down and cache empty)")
+        return pd.DataFrame(), data
+
+    with RUN_REPORT.timed("market.returns", tickers=len(tickers)) as m:
+        results, dropped = compute_returns(data, tickers)
+        m['rows'] = len(results)
+    for ticker, reason in dropped.items():
+        print(f"⚠️ Dropped {ticker}: {reason}")
+    # Failed but still priced = served from cached bars
+    results.attrs['issues'] = {**{t: f"stale, using cached prices ({r})" for t, r in failures.items()},
+                               **{t: f"dropped: {r}" + (f" ({failures[t]})" if t in failures else "") for t, r in dropped.items()}}
+    return results, data
+
+# --- RISK ---
+def demeaned_returns(px):
+    """Daily returns of a (bars x tickers) price array, demeaned per column. Missing returns are
+    set to 0, i.e. to the column mean, so they drop out of every sum of products below.
+    Returns (deviations, validity mask)."""
+    rets = px[1:] / px[:-1] - 1
+    valid = np.isfinite(rets)
+    mean = np.where(valid, rets, 0.0).sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+    return np.where(valid, rets - mean, 0.0), valid
+
+def compute_risk(close, tickers, values, prev_values, benchmark=RISK_BENCHMARK, lookback=RISK_LOOKBACK_BARS):
+    """Per-holding and portfolio risk from the Close panel in one batched pass.
+
+    Everything is a product of the demeaned return matrix D (bars x unique tickers): vol from
+    column norms, beta from D.T @ market, portfolio returns from D @ w, risk contribution from
+    D.T @ (D @ w), and correlations from the normalized D.T @ D. Rows may repeat a ticker (lots).
+    Returns (per-row DataFrame aligned with `tickers`, summary dict).
+    """
+    tickers = np.asarray(tickers, dtype=object).astype(str)
+    values, prev_values = np.asarray(values, dtype=float), np.asarray(prev_values, dtype=float)
+    uniq, inv = np.unique(tickers, return_inverse=True)
+    total = values.sum()
+    w = np.bincount(inv, weights=values, minlength=len(uniq)) / total if total > 0 else np.zeros(len(uniq))
+
+    px = close.reindex(columns=uniq).to_numpy(dtype=float)[-(lookback + 1):]
+    dev, valid = demeaned_returns(px)
+    n = valid.sum(axis=0)
+    bars = len(dev)
+    ss = (dev ** 2).sum(axis=0)
+    has_risk = (n >= 2) & (ss > 0)
+    vol = np.where(has_risk, np.sqrt(ss / np.maximum(n - 1, 1) * TRADING_DAYS) * 100, np.nan)
+
+    beta = np.full(len(uniq), np.nan)
+    if benchmark in close.columns and bars > 1:
+        mkt, _ = demeaned_returns(close[benchmark].to_numpy(dtype=float)[-(lookback + 1):, None])
+        mkt_ss = valid.T @ mkt[:, 0] ** 2  # benchmark variance over each ticker's own bars
+        beta = np.where(has_risk & (mkt_ss > 0), (dev.T @ mkt[:, 0]) / np.where(mkt_ss > 0, mkt_ss, 1), np.nan)
+
+    port_rets = dev @ w
+    port_var = float(port_rets @ port_rets) / max(bars - 1, 1)
+    marginal = dev.T @ port_rets / max(bars - 1, 1)  # cov(holding, portfolio)
+
+    # Correlations: normalized columns, so Z.T @ Z is the matrix and |Z @ 1|^2 sums all of it
+    z = dev[:, has_risk] / np.sqrt(ss[has_risk])
+    k = z.shape[1]
+    avg_corr = float((z.sum(axis=1) @ z.sum(axis=1) - k) / (k * (k - 1))) if k > 1 else None
+    corr, top_pairs = None, []
+    if 1 < k <= RISK_CORR_MAX_TICKERS:
+        names = uniq[has_risk].tolist()
+        corr_m = z.T @ z
+        upper = np.where(np.tri(k, dtype=bool), -np.inf, corr_m)
+        n_pairs = min(5, k * (k - 1) // 2)  # never reach into the masked diagonal / lower triangle
+        top = np.argpartition(upper, -n_pairs, axis=None)[-n_pairs:]
+        flat = top[np.argsort(upper.ravel()[top])[::-1]]
+        top_pairs = [(names[i], names[j], float(corr_m[i, j])) for i, j in zip(*np.unravel_index(flat, upper.shape))]
+        corr = pd.DataFrame(corr_m, index=names, columns=names)
+
+    prev_total = prev_values.sum()
+    pnl = values - prev_values
+    weights_sorted = np.sort(w)[::-1]
+    hhi = float(w @ w)
+    rows = pd.DataFrame({
+        'Weight_Pct': values / total * 100 if total > 0 else 0.0,
+        'Vol_Pct': vol[inv],
+        'Beta': beta[inv],
+        'Day_PnL': pnl,
+        'Contrib_Pct': pnl / prev_total * 100 if prev_total > 0 else 0.0,  # percentage points of the day's move
+        'Risk_Contrib_Pct': (values / total) * marginal[inv] / port_var * 100 if port_var > 0 and total > 0 else 0.0,
+    })
+    summary = {
+        'lookback_bars': bars,
+        'coverage_pct': float(w[has_risk].sum() * 100),
+        'port_vol_pct': float(np.sqrt(port_var * TRADING_DAYS) * 100),
+        'port_beta': float(np.nansum(w * beta)) if np.isfinite(beta).any() else None,
+        'avg_corr': avg_corr,
+        'top_pairs': top_pairs,
+        'corr': corr,
+        'hhi': hhi,
+        'effective_n': 1 / hhi if hhi > 0 else 0.0,
+        'top5_weight_pct': float(weights_sorted[:5].sum() * 100),
+        'largest': (str(uniq[np.argmax(w)]), float(w.max() * 100)) if len(w) else None,
+    }
+    return rows, summary
+
+_genai_client = None
+_genai_lock = threading.Lock()
+
+def get_genai_client():
+    """One client per process; creating it on every call repeats auth and connection setup."""
+    global _genai_client
+    with _genai_lock:
+        if _genai_client is None:
+            from google import genai
+            _genai_client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+        return _genai_client
+
+def ai_fingerprint(port_top, watch_top, total_val, risk=None):
+    """Hash of the prompt inputs with moves rounded to AI_MOVE_TOLERANCE_PCT and net worth to
+    AI_VALUE_TOLERANCE_PCT, so noise between runs doesn't count as a material change."""
+    def bucket(df):
+        return sorted(
+            (t, round(d / AI_MOVE_TOLERANCE_PCT), round(m / AI_MOVE_TOLERANCE_PCT))
+            for t, d, m in zip(df['Ticker'], df['Day_Chg_Pct'], df['Month_Chg_Pct']))
+    value_bucket = round(math.log(total_val) / math.log1p(AI_VALUE_TOLERANCE_PCT / 100)) if total_val > 0 else 0
+    risk_bucket = [round(risk['port_vol_pct']), round(risk['top5_weight_pct'])] if risk else None
+    payload = json.dumps({'port': bucket(port_top), 'watch': bucket(watch_top), 'value': value_bucket, 'risk': risk_bucket}, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+_ai_cache_lock = threading.Lock()
+
+def load_ai_cache(path=None):
+    path = path or AI_CACHE_PATH
+    if not os.path.exists(path): return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_ai_cache_entry(fingerprint, entry, path=None):
+    path = path or AI_CACHE_PATH
+    # Re-read under the lock so concurrent portfolios (batch mode) don't drop each other's entries
+    with _ai_cache_lock:
+        cutoff = time.time() - AI_CACHE_TTL_MINUTES * 60
+        cache = {k: v for k, v in load_ai_cache(path).items() if v.get('created', 0) >= cutoff}
+        cache[fingerprint] = entry
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(cache, f)
+
+def generate_ai_text(model, prompt, budget):
+    def call():
+        return PROVIDERS.generate(model, prompt)
+    with RUN_REPORT.timed(f"ai.{model}", bytes=len(prompt.encode())) as m:
+        status, value = run_with_timeout(call, budget)
+        m['outcome'] = status
+        if status == 'ok' and value: m['bytes'] += len(value.encode())
+    if status == 'timeout': raise TimeoutError(f"{model} exceeded {budget}s")
+    if status == 'error': raise value
+    if not value: raise ValueError(f"{model} returned no text")
+    return value
+
+def estimate_tokens(text):
+    return -(-len(text) // PROMPT_CHARS_PER_TOKEN)
+
+def signed_k(x):
+    """Dense signed dollars for the prompt: 1234 -> '+1.2k'."""
+    for div, suffix in ((1e9, 'B'), (1e6, 'M'), (1e3, 'k')):
+        if abs(x) >= div: return f"{x / div:+.1f}{suffix}"
+    return f"{x:+.0f}"
+
+def prompt_sections(port_df, watch_df):
+    """Aggregates for the AI prompt, most important first: (title, legend, items, tickers, count).
+    Items are dense strings in priority order; count is how many rows qualified before the cap."""
+    value = port_df['Value'].to_numpy(dtype=float)
+    pnl = value - port_df['Prev_Value'].to_numpy(dtype=float)
+    total = value.sum()
+    weight = value / total * 100 if total > 0 else np.zeros(len(value))
+    tickers = port_df['Ticker'].to_numpy()
+    day, month = port_df['Day_Chg_Pct'].to_numpy(dtype=float), port_df['Month_Chg_Pct'].to_numpy(dtype=float)
+
+    def top(order, mask=None):
+        idx = order if mask is None else order[mask[order]]
+        return idx[:PROMPT_SECTION_CANDIDATES], len(idx)
+
+    sections = []
+    group = next((c for c in PROMPT_GROUP_COLUMNS if c in port_df.columns), None)
+    if group:
+        names = port_df[group].replace('', None).fillna('Other').astype(str).to_numpy()
+        agg = pd.DataFrame({'g': names, 'w': weight, 'pnl': pnl, 'prev': port_df['Prev_Value'].to_numpy(dtype=float)}).groupby('g').sum()
+        agg = agg.reindex(agg['pnl'].abs().sort_values(ascending=False).index)
+        items = [f"{g} w{w:.0f} {p / prev * 100 if prev > 0 else 0:+.1f}% {signed_k(p)}" for g, w, p, prev in agg.itertuples()]
+        sections.append((group.upper(), "name weight% day% day$", items, [], len(items)))
+
+    idx, n = top(np.argsort(-np.abs(pnl), kind='stable'))
+    sections.append(("TOP P&L", "ticker day%/month% day$ weight%",
+                     [f"{tickers[i]} {day[i]:+.1f}/{month[i]:+.0f} {signed_k(pnl[i])} {weight[i]:.1f}" for i in idx], list(tickers[idx]), n))
+
+    idx, n = top(np.argsort(-np.abs(month), kind='stable'), np.abs(month) >= OVEREXTENDED_PCT)
+    sections.append((f"OVEREXTENDED >{OVEREXTENDED_PCT:.0f}% MONTH", "ticker month% weight%",
+                     [f"{tickers[i]} {month[i]:+.0f} {weight[i]:.1f}" for i in idx], list(tickers[idx]), n))
+
+    w_tickers = watch_df['Ticker'].to_numpy()
+    w_day, w_month = watch_df['Day_Chg_Pct'].to_numpy(dtype=float), watch_df['Month_Chg_Pct'].to_numpy(dtype=float)
+    w_order = np.argsort(-np.abs(w_day), kind='stable')
+    for title, mask in (("WATCHLIST REVERSALS", reversal_mask(w_day, w_month)), ("WATCHLIST MOVERS", None)):
+        idx, n = top(w_order, mask)
+        sections.append((title, "ticker day%/month%", [f"{w_tickers[i]} {w_day[i]:+.1f}/{w_month[i]:+.0f}" for i in idx], list(w_tickers[idx]), n))
+    return sections
+
+def fit_prompt_sections(sections, budget_chars):
+    """Take items round-robin across sections (so none gets starved) until budget_chars is spent.
+    Returns how many items of each section fit."""
+    taken, used, open_ = [0] * len(sections), 0, set(range(len(sections)))
+    while open_:
+        for k in sorted(open_):
+            items = sections[k][2]
+            cost = len(items[taken[k]]) + 2 if taken[k] < len(items) else None
+            if cost is None or used + cost > budget_chars:
+                open_.discard(k)
+                continue
+            taken[k] += 1
+            used += cost
+    return taken
+
+def build_ai_prompt(port_df, watch_df, total_val, day_gain_dollar, risk=None, budget=PROMPT_TOKEN_BUDGET):
+    """(prompt, port_rows, watch_rows): the prompt within `budget` tokens, and the holdings and
+    watchlist rows that made it in (what the AI cache fingerprints)."""
+    prev = total_val - day_gain_dollar
+    status = (f"Net ${signed_k(total_val)[1:]} | Day {signed_k(day_gain_dollar)} ({day_gain_dollar / prev * 100 if prev > 0 else 0:+.2f}%)"
+              f" | {len(port_df)} holdings, {len(watch_df)} watchlist")
+    risk_str = "n/a"
+    if risk:
+        drivers = port_df.nlargest(5, 'Risk_Contrib_Pct')
+        risk_str = format_risk_summary(risk) + " | Drivers (ticker risk% beta): " + "; ".join(
+            f"{t} {r:.0f} {b:.2f}" for t, r, b in zip(drivers['Ticker'], drivers['Risk_Contrib_Pct'], drivers['Beta'].fillna(0)))
+
+    head = f"""You are a Hedge Fund CIO. Data is dense: sections list "items; items", legend in (), n=shown/qualifying.
+STATUS: {status}
+RISK: {risk_str}"""
+    task = """TASK: Write a 3-bullet executive summary in pure HTML (no markdown code blocks).
+1. <b>The Why:</b> Analyze drivers (Macro vs Company) using TOP P&L and any sector buckets.
+2. <b>The Risk:</b> Identify OVEREXTENDED positions and concentration, beta or correlation issues from RISK.
+3. <b>The Hunt:</b> Flag Reversal setups in the Watchlist.
+CRITICAL: End your response with a section titled "<br><b>🔗 Sources:</b>" followed by an HTML unordered list (<ul>) containing 1-2 direct links (<a href='...'>Article Title</a>) to the news used."""
+
+    sections = prompt_sections(port_df, watch_df)
+    headers = [f"{title} ({legend}; n=0000/{count}): " for title, legend, _, _, count in sections]  # widest "shown" count
+    fixed = len(head) + len(task) + sum(len(h) + 1 for h in headers) + 2
+    taken = fit_prompt_sections(sections, budget * PROMPT_CHARS_PER_TOKEN - fixed)
+
+    lines, shown = [head], {'port': set(), 'watch': set()}
+    for (title, legend, items, tickers, count), k in zip(sections, taken):
+        lines.append(f"{title} ({legend}; n={k}/{count}): " + ("; ".join(items[:k]) or "none"))
+        shown['watch' if title.startswith("WATCHLIST") else 'port'].update(tickers[:k])
+    lines.append(task)
+    return ("\n".join(lines), port_df[port_df['Ticker'].isin(shown['port'])],
+            watch_df[watch_df['Ticker'].isin(shown['watch'])])
+
+def get_ai_insights(port_df, watch_df, total_val, day_gain_dollar, risk=None):
+    try:
+        with RUN_REPORT.timed("ai.prompt", tickers=len(port_df) + len(watch_df)) as m:
+            prompt, port_top, watch_top = build_ai_prompt(port_df, watch_df, total_val, day_gain_dollar, risk)
+            m['prompt_bytes'], m['tokens'] = len(prompt.encode()), estimate_tokens(prompt)
+
+        fingerprint = ai_fingerprint(port_top, watch_top, total_val, risk)
+        hit = load_ai_cache().get(fingerprint)
+        if hit and time.time() - hit['created'] < AI_CACHE_TTL_MINUTES * 60:
+            print(f"🧠 Reusing AI summary from {(time.time() - hit['created']) / 60:.0f} min ago (inputs unchanged)")
+            return hit['text']
+        
+        print(f"🧠 Asking {AI_MODEL_NAME} (~{estimate_tokens(prompt)} prompt tokens)...")
+        try:
+            text = generate_ai_text(AI_MODEL_NAME, prompt, AI_LATENCY_BUDGET)
+            model = AI_MODEL_NAME
+        except Exception as e:
+            print(f"⚠️ {AI_MODEL_NAME} failed ({e}). Falling back to {AI_FALLBACK_MODEL}...")
+            text = generate_ai_text(AI_FALLBACK_MODEL, prompt, AI_FALLBACK_BUDGET)
+            model = AI_FALLBACK_MODEL
         
-        text = response.text
         # CLEANER: Remove markdown code blocks if present
         text = text.replace("```html", "").replace("```", "")
+        save_ai_cache_entry(fingerprint, {'text': text, 'created': time.time(), 'model': model})
         return text
         
     except Exception as e:
         return f"<i>AI Analysis Unavailable: {e}</i>"
 
-def generate_chart(history_data):
-    if len(history_data) < 2: return None
-    
-    # Reset to Standard Light Theme
-    plt.style.use('default')
-    
-    df = pd.DataFrame(history_data)
-    df['Date'] = pd.to_datetime(df['Date'])
-    df = df.sort_values('Date').tail(30)
-    
-    start_val = float(df['Total_Value'].iloc[0])
-    end_val = float(df['Total_Value'].iloc[-1])
+HISTORY_DTYPE = np.dtype([('date', '<i4'), ('total_value', '<f8'), ('total_gain_loss', '<f8')])
+
+class HistoryStore:
+    """Local, append-only mirror of History_Log: fixed-width (date, total_value, total_gain_loss)
+    records in a memory-mapped .bin file, plus a JSON sidecar with running stats.
+
+    High-water mark and max drawdown are folded in on every append, and rolling N-day
+    changes are a binary search on the date column, so nothing ever rescans the full log.
+    The sheet stays the source of truth: if its row count drifts from ours we reseed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state_path = path + ".json"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    self.state = json.load(f)
+            except ValueError:
+                pass  # truncated by a killed run: no sheet_rows, so the next sync reseeds
+        self._map()
+
+    resident = None  # path -> store, kept across runs in daemon mode
+
+    @classmethod
+    def for_sheet(cls, sheet_name):
+        path = os.path.join(HISTORY_DIR, re.sub(r'[^A-Za-z0-9_-]+', '_', sheet_name) + ".bin")
+        if cls.resident is None: return cls(path)
+        store = cls.resident.get(path)
+        if store is None or not os.path.exists(path):  # first use, or the cache dir was wiped
+            store = cls.resident[path] = cls(path)
+        return store
+
+    def _map(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size and size % HISTORY_DTYPE.itemsize == 0:
+            self.data = np.memmap(self.path, dtype=HISTORY_DTYPE, mode='r')
+        else:
+            self.data = np.empty(0, dtype=HISTORY_DTYPE)
+
+    def __len__(self):
+        return len(self.data)
+
+    def _save_state(self):
+        # Temp file + rename, so a run killed mid-write never leaves half a JSON behind
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.state_path) or ".", suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    @staticmethod
+    def _fold(base, value):
+        hwm = max(base.get('hwm', value), value)
+        drawdown = (value / hwm - 1) * 100 if hwm > 0 else 0.0
+        return {'hwm': hwm, 'max_drawdown_pct': min(base.get('max_drawdown_pct', 0.0), drawdown), 'drawdown_pct': drawdown}
+
+    def _refresh_stats(self):
+        if not len(self.data):
+            self.state['stats'] = {}
+            return
+        last = self.data[-1]
+        stats = self._fold(self.state.get('base', {}), float(last['total_value']))
+        dates = self.data['date']
+        for days in ROLLING_WINDOWS:
+            target = int(last['date']) - days
+            idx = int(np.searchsorted(dates, target, side='left'))
+            start = float(self.data['total_value'][idx]) if dates[0] <= target and idx < len(dates) - 1 else 0.0
+            stats[f'chg_{days}d_pct'] = (float(last['total_value']) / start - 1) * 100 if start > 0 else None
+        self.state['stats'] = stats
+
+    def seed(self, records):
+        """Rebuild from History_Log records (one-off, when the local copy is missing or stale)."""
+        df = pd.DataFrame(records, columns=['Date', 'Total_Value', 'Total_Gain_Loss'])
+        dates = pd.to_datetime(df['Date'].astype(str), errors='coerce')
+        values = pd.to_numeric(df['Total_Value'], errors='coerce')
+        gains = pd.to_numeric(df['Total_Gain_Loss'], errors='coerce').fillna(0.0)
+        keep = dates.notna() & (values > 0)  # blank / $0 rows would wreck scale and drawdown
+        clean = pd.DataFrame({'date': dates[keep].values.astype('datetime64[D]').astype('<i4'),
+                              'total_value': values[keep], 'total_gain_loss': gains[keep]})
+        clean = clean.drop_duplicates('date', keep='last').sort_values('date')
+
+        arr = np.empty(len(clean), dtype=HISTORY_DTYPE)
+        for name in HISTORY_DTYPE.names:
+            arr[name] = clean[name].to_numpy()
+        arr.tofile(self.path)
+
+        vals = arr['total_value'][:-1]
+        if len(vals):
+            hwm = np.maximum.accumulate(vals)
+            base = {'hwm': float(hwm[-1]), 'max_drawdown_pct': float(((vals / hwm - 1) * 100).min())}
+        else:
+            base = {}
+        self.state = {'sheet_rows': len(records), 'base': base}
+        self._map()
+        self._refresh_stats()
+        self._save_state()
+        print(f"🗄️ Seeded local history with {len(arr)} rows")
+
+    def sync(self, records):
+        if self.state.get('sheet_rows') != len(records) or not len(self.data):
+            self.seed(records)
+
+    def append(self, date_str, total_value, total_gain_loss):
+        rec = np.array([(np.datetime64(date_str, 'D').astype('<i4'), total_value, total_gain_loss)], dtype=HISTORY_DTYPE)
+        day = int(rec['date'][0])
+        if len(self.data) and int(self.data[-1]['date']) == day:
+            # Same-day rerun: overwrite the last record in place, stats base is unchanged
+            with open(self.path, 'r+b') as f:
+                f.seek((len(self.data) - 1) * HISTORY_DTYPE.itemsize)
+                f.write(rec.tobytes())
+        elif len(self.data) and int(self.data[-1]['date']) > day:
+            return
+        else:
+            if len(self.data):
+                prev = self._fold(self.state.get('base', {}), float(self.data[-1]['total_value']))
+                self.state['base'] = {'hwm': prev['hwm'], 'max_drawdown_pct': prev['max_drawdown_pct']}
+            with open(self.path, 'ab') as f:
+                f.write(rec.tobytes())
+            self.state['sheet_rows'] = self.state.get('sheet_rows', 0) + 1
+        self._map()
+        self._refresh_stats()
+        self._save_state()
+
+    @property
+    def stats(self):
+        return self.state.get('stats', {})
+
+    def window(self, points=CHART_POINTS):
+        """Last `points` records as (datetime64[D] dates, values) for the trend chart."""
+        tail = np.array(self.data[-points:])
+        return tail['date'].astype('datetime64[D]'), tail['total_value']
+
+def prepare_chart(dates, values):
+    """Everything about the trend chart that doesn't depend on size or renderer."""
+    start_val = float(values[0])
+    end_val = float(values[-1])
     
     if start_val > 0:
         pct_change = ((end_val - start_val) / start_val) * 100
@@ -130,150 +1262,485 @@ def generate_chart(history_data):
         pct_change = 0.0
     
     # Calculate actual date range for accurate title
-    date_range_days = (df['Date'].iloc[-1] - df['Date'].iloc[0]).days
+    date_range_days = int((dates[-1] - dates[0]).astype(int))
     if date_range_days > 0:
         title_prefix = f"{date_range_days}-Day Trend"
     else:
         title_prefix = "Trend"
         
     sign = "+" if pct_change >= 0 else ""
-    title_str = f"{title_prefix} ({sign}{pct_change:.2f}%)"
-    
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.plot(df['Date'], df['Total_Value'], marker='.', color='#0052cc', linewidth=2)
-    ax.fill_between(df['Date'], df['Total_Value'], alpha=0.1, color='#0052cc')
-    
-    title_color = 'green' if pct_change >= 0 else 'red'
-    ax.set_title(title_str, fontsize=14, fontweight='bold', color=title_color)
     
     # FIX: Set Y-axis to actual data range with 5% padding for better granularity
-    y_min = df['Total_Value'].min()
-    y_max = df['Total_Value'].max()
+    y_min = values.min()
+    y_max = values.max()
     y_padding = (y_max - y_min) * 0.1  # 10% padding
     
     # Handle edge case where all values are the same
     if y_padding == 0:
         y_padding = y_min * 0.02  # 2% of value if no variation
     
-    ax.set_ylim(y_min - y_padding, y_max + y_padding)
+    return {
+        'dates': dates, 'values': values, 'pct_change': pct_change,
+        'title': f"{title_prefix} ({sign}{pct_change:.2f}%)",
+        'title_color': 'green' if pct_change >= 0 else 'red',
+        'ylim': (y_min - y_padding, y_max + y_padding),
+    }
+
+def chart_cache_key(dates, values, size, renderer):
+    h = hashlib.sha256(f"{CHART_STYLE_VERSION}|{renderer}|{size}|".encode())
+    h.update(np.ascontiguousarray(dates).tobytes())
+    h.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    return h.hexdigest()[:24]
+
+def generate_charts(dates, values, sizes=None, renderer=None):
+    """{size: PNG buffer} for each of `sizes` (keys of CHART_SIZES), all from one prepared series.
+    PNGs are cached in CHART_CACHE_DIR by a hash of the plotted points, so an unchanged
+    window costs a file read and never imports matplotlib."""
+    if len(values) < 2: return {}
+    sizes, renderer = sizes or list(CHART_SIZES), renderer or CHART_RENDERER
+    chart, out = None, {}
+    os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+    for size in sizes:
+        path = os.path.join(CHART_CACHE_DIR, chart_cache_key(dates, values, size, renderer) + ".png")
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                out[size] = io.BytesIO(f.read())
+            continue
+        chart = chart or prepare_chart(dates, values)
+        with RUN_REPORT.timed(f"chart.draw.{renderer}", size=size) as m:
+            png = optimize_png(CHART_RENDERERS[renderer](chart, *CHART_SIZES[size]))
+            m['bytes'] = len(png)
+        # Unique temp name: batch accounts with the same series render the same PNG at once
+        fd, tmp = tempfile.mkstemp(dir=CHART_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+        out[size] = io.BytesIO(png)
+    if chart is not None: prune_chart_cache()
+    return out
+
+def generate_chart(dates, values, size=None, renderer=None):
+    size = size or CHART_SIZE
+    return generate_charts(dates, values, [size], renderer).get(size)
+
+def prune_chart_cache():
+    cutoff = time.time() - CHART_CACHE_MAX_AGE_DAYS * 86400
+    for name in os.listdir(CHART_CACHE_DIR):
+        path = os.path.join(CHART_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff: os.remove(path)
+        except OSError:
+            pass  # another run got there first
+
+_mpl_lock = threading.Lock()
+_mpl = None
+
+def load_matplotlib():
+    """Import matplotlib (Agg) and reset the style once per process instead of on every chart."""
+    global _mpl
+    with _mpl_lock:
+        if _mpl is None:
+            import matplotlib
+            matplotlib.use('Agg')  # charts render off the main thread
+            from matplotlib import style
+            from matplotlib.figure import Figure
+            from matplotlib.ticker import FuncFormatter
+            # Reset to Standard Light Theme
+            style.use('default')
+            _mpl = (Figure, FuncFormatter)
+        return _mpl
+
+def render_matplotlib(chart, width, height, dpi):
+    Figure, FuncFormatter = load_matplotlib()
+    dates, values = chart['dates'], chart['values']
+    
+    # Figure API instead of pyplot's global "current figure": batch mode renders several charts at once
+    fig = Figure(figsize=(width, height))
+    ax = fig.subplots()
+    ax.plot(dates, values, marker='.', color='#0052cc', linewidth=2)
+    ax.fill_between(dates, values, alpha=0.1, color='#0052cc')
+    
+    ax.set_title(chart['title'], fontsize=14, fontweight='bold', color=chart['title_color'])
+    ax.set_ylim(*chart['ylim'])
     
     # Format Y-axis with dollar signs and commas
-    ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'${x:,.0f}'))
+    ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: f'${x:,.0f}'))
     
     ax.grid(True, linestyle='--', alpha=0.3)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
     
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close()
-    return buf
+    fig.savefig(buf, format='png', dpi=dpi)
+    return buf.getvalue()
+
+def optimize_png(data, colors=CHART_PNG_COLORS):
+    """Palette-quantize a PNG (a 10x4 chart goes from ~45 KB to ~13 KB). Pillow ships with
+    matplotlib; without it the PNG is returned as is."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    out = io.BytesIO()
+    Image.open(io.BytesIO(data)).convert('RGB').quantize(colors=colors).save(out, format='PNG', optimize=True)
+    return out.getvalue() if out.tell() < len(data) else data
+
+def encode_png(rgb):
+    """Minimal 8-bit RGB PNG writer (zlib only) for an (H, W, 3) uint8 array."""
+    h, w, _ = rgb.shape
+    raw = np.hstack([np.zeros((h, 1), dtype=np.uint8), rgb.reshape(h, w * 3)]).tobytes()  # filter 0 per row
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+def render_sparkline(chart, width, height, dpi):
+    """Axis-less sparkline drawn straight into a pixel array: anti-aliased line, markers and
+    area fill in the trend color. No text, so the chart's title goes unused."""
+    W, H = int(width * dpi), int(height * dpi)
+    pad = max(6, H // 25)
+    x_days = (chart['dates'] - chart['dates'][0]).astype(float)
+    lo, hi = chart['ylim']
+    xs = pad + x_days / max(x_days[-1], 1) * (W - 2 * pad)
+    ys = pad + (hi - chart['values']) / (hi - lo) * (H - 2 * pad)
+    color = np.array([0x27, 0xae, 0x60] if chart['pct_change'] >= 0 else [0xc0, 0x39, 0x2b], dtype=float)
+
+    img = np.full((H, W, 3), 255.0)
+    def blend(alpha, y0=0, x0=0):
+        region = img[y0:y0 + alpha.shape[0], x0:x0 + alpha.shape[1]]
+        region += (color - region) * alpha[..., None]
+
+    for gy in np.linspace(pad, H - pad, 5):  # light horizontal grid
+        img[int(gy), pad:W - pad] = 235
+    col_y = np.interp(np.arange(W), xs, ys)  # area fill under the line
+    fill = (np.arange(H)[:, None] >= col_y[None, :]) & (np.arange(W)[None, :] >= xs[0]) & (np.arange(W)[None, :] <= xs[-1])
+    blend(fill * 0.12)
+
+    half = max(1.0, H / 160)  # line half-width in px
+    for (x0, y0), (x1, y1) in zip(zip(xs[:-1], ys[:-1]), zip(xs[1:], ys[1:])):
+        bx0, bx1 = int(max(min(x0, x1) - half - 1, 0)), int(min(max(x0, x1) + half + 2, W))
+        by0, by1 = int(max(min(y0, y1) - half - 1, 0)), int(min(max(y0, y1) + half + 2, H))
+        py, px = np.mgrid[by0:by1, bx0:bx1]
+        dx, dy = x1 - x0, y1 - y0
+        t = np.clip(((px - x0) * dx + (py - y0) * dy) / max(dx * dx + dy * dy, 1e-9), 0, 1)
+        dist = np.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+        blend(np.clip(half + 0.5 - dist, 0, 1), by0, bx0)
+    r = half * 2
+    for x, y in zip(xs, ys):  # point markers
+        bx0, by0 = int(max(x - r - 1, 0)), int(max(y - r - 1, 0))
+        py, px = np.mgrid[by0:int(min(y + r + 2, H)), bx0:int(min(x + r + 2, W))]
+        blend(np.clip(r + 0.5 - np.hypot(px - x, py - y), 0, 1), by0, bx0)
+    return encode_png(np.clip(img, 0, 255).astype(np.uint8))
+
+CHART_RENDERERS = {'matplotlib': render_matplotlib, 'sparkline': render_sparkline}
 
-def send_email(subject, body, img_buf):
+# --- PAYLOAD ---
+STYLE_ATTR = re.compile(r"""style=(["'])(.*?)\1""", re.S)
+
+def minify_html(html):
+    """Drop comments and template indentation. Whitespace inside a line is kept (collapsed)."""
+    html = re.sub(r'<!--.*?-->', '', html, flags=re.S)
+    html = re.sub(r'>\s*\n\s*<', '><', html)
+    return re.sub(r'\s+', ' ', html).strip()
+
+def styles_to_classes(html):
+    """Move every inline style used more than once into a <style> class (EMAIL_STYLE_CLASSES).
+    Gmail, Apple Mail and Outlook honor <head> styles, but not every client does."""
+    counts = Counter(m.group(2) for m in STYLE_ATTR.finditer(html))
+    names = {}
+    for style, n in counts.most_common():
+        if n < 2: break
+        names[style] = f"s{len(names)}"
+    if not names: return html
+    html = STYLE_ATTR.sub(lambda m: f"class='{names[m.group(2)]}'" if m.group(2) in names else m.group(0), html)
+    css = "<style>" + "".join(f".{c}{{{s.strip()}}}" for s, c in names.items()) + "</style>"
+    return html.replace("</head>", css + "</head>", 1) if "</head>" in html else css + html
+
+def compact_html(html):
+    html = minify_html(html)
+    return styles_to_classes(html) if EMAIL_STYLE_CLASSES else html
+
+def fit_email_html(build):
+    """Compact build(max_rows) for each of EMAIL_ROW_STEPS until it fits EMAIL_HTML_BUDGET.
+    Returns (html, max_rows used)."""
+    for max_rows in EMAIL_ROW_STEPS:
+        html = build(max_rows)
+        if len(html) > EMAIL_HTML_BUDGET * EMAIL_MAX_COMPACTION and max_rows != EMAIL_ROW_STEPS[-1]:
+            continue
+        html = compact_html(html)
+        size = len(html.encode())
+        if size <= EMAIL_HTML_BUDGET: break
+    if size > EMAIL_HTML_BUDGET:
+        print(f"⚠️ Email HTML is {size / 1024:.0f} KB even at {max_rows} rows per table; Gmail will clip it")
+    elif max_rows is not None:
+        print(f"✂️ Tables cut to the {max_rows} biggest movers to stay under {EMAIL_HTML_BUDGET // 1000} KB")
+    return html, max_rows
+
+def html_part(html):
+    """text/html part in whichever of quoted-printable / base64 comes out smaller."""
+    qp = Charset('utf-8')
+    qp.body_encoding = QP
+    return min(MIMEText(html, 'html', 'utf-8'), MIMEText(html, 'html', qp), key=lambda p: len(p.as_bytes()))
+
+def build_message(subject, body, img_buf, recipients=None):
     msg = MIMEMultipart()
     msg['Subject'] = subject
     msg['From'] = os.environ["GMAIL_USER"]
-    msg['To'] = os.environ["GMAIL_USER"]
-    msg.attach(MIMEText(body, 'html'))
+    msg['To'] = ", ".join(recipients or [os.environ["GMAIL_USER"]])
+    msg.attach(html_part(body))
     if img_buf:
-        img = MIMEImage(img_buf.read())
+        img = MIMEImage(img_buf.getvalue())
         img.add_header('Content-ID', '<chart>')
         msg.attach(img)
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as s:
-        s.login(os.environ["GMAIL_USER"], os.environ["GMAIL_PASS"])
-        s.send_message(msg)
-
-def make_rows(df, cols, is_watch=False):
-    rows = ""
-    for _, r in df.iterrows():
-        rows += "<tr>"
-        for c in cols:
-            val = r[c]
-            if c == "Ticker":
-                rows += f"<td style='text-align:left; font-weight:bold; padding:6px; border-bottom:1px solid #f0f0f0;'>{val}</td>"
-            elif isinstance(val, (float, int)):
-                if "Pct" in c:
-                    color = "#27ae60" if val >= 0 else "#c0392b"
-                    rows += f"<td style='color:{color}; text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:+.2f}%</td>"
-                elif "Gain" in c:
-                    color = "#27ae60" if val >= 0 else "#c0392b"
-                    rows += f"<td style='color:{color}; text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:,.0f}</td>"
-                else: 
-                    rows += f"<td style='text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:,.2f}</td>"
+    return msg
+
+def open_smtp():
+    return PROVIDERS.smtp()
+
+def send_email(subject, body, img_buf, recipients=None, smtp=None):
+    """Send one report. Pass an open `smtp` session to reuse it (batch mode)."""
+    with RUN_REPORT.timed("email.build_mime") as m:
+        msg = build_message(subject, body, img_buf, recipients)
+        m['bytes'] = len(msg.as_bytes())
+        m['html_bytes'] = len(body.encode())
+        m['png_bytes'] = img_buf.getbuffer().nbytes if img_buf else 0
+    print(f"📦 Message {m['bytes'] / 1024:.1f} KB (HTML {m['html_bytes'] / 1024:.1f} KB, chart {m['png_bytes'] / 1024:.1f} KB)")
+    with RUN_REPORT.timed("email.smtp_send", bytes=m['bytes']):
+        if smtp is not None:
+            smtp.send_message(msg)
+            return
+        with open_smtp() as s:
+            s.send_message(msg)
+
+# --- ALERTS ---
+_alert_state_lock = threading.Lock()
+
+def reversal_mask(day, month):
+    """A day move against a big month move: the watchlist reversal setup (alerts and AI prompt)."""
+    return (np.abs(month) >= ALERT_REVERSAL_MONTH_PCT) & (np.abs(day) >= ALERT_REVERSAL_DAY_PCT) & (np.sign(day) == -np.sign(month))
+
+class AlertEngine:
+    """Threshold rules over a computed run, for one portfolio.
+
+    Each rule maps to keyed levels (0 = quiet, 1 = threshold crossed, 2 = twice the threshold...).
+    What fired earlier today is kept in ALERT_STATE_PATH, so only new or escalated keys count as
+    fired; a run where nothing fired is quiet and can skip Gemini and the chart.
+    """
+    def __init__(self, key=SHEET_NAME, path=None):
+        self.key = key
+        self.path = path or ALERT_STATE_PATH
+
+    def _load_all(self):
+        if not os.path.exists(self.path): return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _steps(values, threshold):
+        return np.floor(np.abs(np.asarray(values, dtype=float)) / threshold).astype(int)
+
+    def levels(self, ctx, history_stats):
+        """{key: (level, message)} for every rule at or above its threshold."""
+        out = {}  # portfolio-wide rules first: the email lists only the first ALERT_DISPLAY_MAX
+        lvl = int(self._steps([ctx['day_change_pct']], ALERT_PORTFOLIO_MOVE_PCT)[0])
+        if lvl: out["portfolio"] = (lvl, f"Portfolio {ctx['day_change_pct']:+.2f}% today ({ctx['day_gain_dollar']:+,.0f})")
+
+        dd = (history_stats or {}).get('drawdown_pct')
+        if dd is not None and dd < 0:
+            lvl = int(self._steps([dd], ALERT_DRAWDOWN_PCT)[0])
+            if lvl: out["drawdown"] = (lvl, f"Drawdown {dd:.1f}% from the high-water mark")
+
+        vix = ctx.get('vix')
+        if vix:
+            lvl = int(vix['price'] // ALERT_VIX_LEVEL)
+            if lvl: out["vix_level"] = (lvl, f"VIX at {vix['price']:.1f}")
+            if vix['day_pct'] > 0:
+                lvl = int(self._steps([vix['day_pct']], ALERT_VIX_JUMP_PCT)[0])
+                if lvl: out["vix_jump"] = (lvl, f"VIX {vix['day_pct']:+.1f}% today")
+
+        port = ctx['port_merged']
+        day = port['Day_Chg_Pct'].fillna(0).to_numpy(dtype=float)
+        steps = self._steps(day, ALERT_MOVE_PCT)
+        for i in np.argsort(-np.abs(day))[:int((steps > 0).sum())]:  # biggest moves first
+            out[f"move:{port['Ticker'].iloc[i]}"] = (int(steps[i]), f"{port['Ticker'].iloc[i]} {day[i]:+.1f}% today")
+
+        watch = ctx['watch_merged']
+        day, month = watch['Day_Chg_Pct'].to_numpy(dtype=float), watch['Month_Chg_Pct'].to_numpy(dtype=float)
+        rev = reversal_mask(day, month)
+        for t, d, m in zip(watch['Ticker'][rev], day[rev], month[rev]):
+            out[f"reversal:{t}"] = (1, f"{t} reversal: {d:+.1f}% today after {m:+.1f}% this month")
+        return out
+
+    def evaluate(self, ctx, history_stats, today):
+        """{'fired': [messages], 'active': [messages], 'quiet': bool, 'state': ...}. Nothing is
+        saved until commit(), so an email that never went out doesn't swallow its alerts."""
+        prev = self._load_all().get(self.key, {})
+        seen = prev.get('levels', {}) if prev.get('date') == today else {}
+        current = self.levels(ctx, history_stats)
+        fired = [msg for k, (lvl, msg) in current.items() if lvl > seen.get(k, 0)]
+        levels = {**seen, **{k: max(lvl, seen.get(k, 0)) for k, (lvl, _) in current.items()}}
+        if fired: print(f"🔔 {len(fired)} alert(s): " + "; ".join(fired))
+        else: print("💤 No new alerts.")
+        return {'fired': fired, 'active': [msg for _, msg in current.values()], 'quiet': not fired,
+                'state': {'date': today, 'levels': levels}}
+
+    def commit(self, evaluation):
+        if not evaluation or evaluation.get('state') is None: return
+        with _alert_state_lock:  # batch mode: one file, several portfolios
+            data = self._load_all()
+            data[self.key] = evaluation['state']
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(data, f)
+
+def skip_when_quiet(alerts):
+    return alerts['quiet'] and QUIET_MODE != 'full'
+
+# --- TABLE RENDERING ---
+# Each style string lives here once; cells pick an opening tag per column kind / sign.
+CELL_BASE = "padding:6px; border-bottom:1px solid #f0f0f0;"
+CELL_STYLES = {
+    'ticker': f"text-align:left; font-weight:bold; {CELL_BASE}",
+    'num': f"text-align:right; {CELL_BASE}",
+    'pos': f"color:#27ae60; text-align:right; {CELL_BASE}",
+    'neg': f"color:#c0392b; text-align:right; {CELL_BASE}",
+    'blank': CELL_BASE,
+}
+HOLDINGS_COLS = ['Ticker', 'Price', 'Day_Chg_Pct', 'Month_Chg_Pct', 'Total_Gain_Loss']
+WATCH_COLS = ['Ticker', 'Price', 'Day_Chg_Pct', 'Month_Chg_Pct']
+HEADER_STYLE = "background: #f8f9fa; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;"
+DIVIDER_CELL = "<td style='width:2px; background-color:#ccc; padding:0;'></td>"
+DIVIDER_HEADER = '<th style="width: 2px; background-color: #ccc; padding: 0; border-bottom: 2px solid #ccc;"></th>'
+RISK_COLS = ['Ticker', 'Weight_Pct', 'Vol_Pct', 'Beta', 'Day_PnL', 'Contrib_Pct', 'Risk_Contrib_Pct']
+UNSIGNED_PCT_COLS = {'Weight_Pct', 'Vol_Pct', 'Risk_Contrib_Pct'}  # sizes, not moves: no +/- or color
+COLUMN_LABELS = {'Ticker': 'Ticker', 'Price': 'Price', 'Day_Chg_Pct': 'Day %', 'Month_Chg_Pct': 'Mth %', 'Total_Gain_Loss': 'Total G/L',
+                 'Weight_Pct': 'Weight', 'Vol_Pct': 'Vol (ann.)', 'Beta': 'Beta', 'Day_PnL': 'Day P&amp;L',
+                 'Contrib_Pct': 'Day Contrib', 'Risk_Contrib_Pct': 'Risk Share'}
+
+def column_format(col):
+    """(format, signed) for a column: signed columns are colored green/red."""
+    if col in UNSIGNED_PCT_COLS: return "{:.1f}%", False
+    if "Pct" in col: return "{:+.2f}%", True
+    if "Gain" in col or "PnL" in col: return "{:,.0f}", True
+    return "{:,.2f}", False
+
+def format_column(series, col):
+    """Render a whole column to a list of <td> strings in one pass."""
+    if col == "Ticker":
+        tag = f"<td style='{CELL_STYLES['ticker']}'>"
+        return [f"{tag}{v}</td>" for v in series.astype(str).tolist()]
+
+    values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)
+    fmt, signed = column_format(col)
+    text = np.array([fmt.format(v) for v in values.tolist()], dtype=object)
+    if signed:
+        tags = np.where(values >= 0, f"<td style='{CELL_STYLES['pos']}'>", f"<td style='{CELL_STYLES['neg']}'>")
+    else:
+        tags = np.full(len(values), f"<td style='{CELL_STYLES['num']}'>", dtype=object)
+
+    # Anything that isn't a number is shown as-is, like the sheet has it; missing values as "n/a"
+    missing = np.isnan(values)
+    if missing.any():
+        text[missing] = ["n/a" if pd.isna(v) else str(v) for v in series.to_numpy(dtype=object)[missing]]
+        tags[missing] = f"<td style='{CELL_STYLES['num']}'>"
+    return (tags.astype(object) + text + "</td>").tolist()
+
+def render_cells(df, cols):
+    """Inner HTML (cells only) of each row."""
+    if df.empty: return []
+    return ["".join(cells) for cells in zip(*[format_column(df[c], c) for c in cols])]
+
+def render_header(cols, label_map=COLUMN_LABELS):
+    return "".join(
+        f'<th style="{HEADER_STYLE} text-align: {"left" if c == "Ticker" else "right"};">{label_map.get(c, c)}</th>'
+        for c in cols)
+
+def render_rows(df, cols):
+    return "".join(f"<tr>{cells}</tr>" for cells in render_cells(df, cols))
+
+def render_split_rows(left_df, right_df, cols):
+    """Two tables side by side in one, separated by a vertical divider."""
+    left, right = render_cells(left_df, cols), render_cells(right_df, cols)
+    blank = f"<td style='{CELL_STYLES['blank']}'>&nbsp;</td>" * len(cols)
+    n = max(len(left), len(right))
+    left += [blank] * (n - len(left))
+    right += [blank] * (n - len(right))
+    return "".join(f"<tr>{l}{DIVIDER_CELL}{r}</tr>" for l, r in zip(left, right))
+
+class PipelineAbort(Exception):
+    """Raised by a stage to end the run cleanly (e.g. no market data to report on)."""
+
+class Stage:
+    """One node of the run graph. fallback(reason) supplies a value when the stage fails or
+    misses its deadline; stages without a fallback are required and fail the run."""
+    def __init__(self, name, fn, deps=(), timeout=None, fallback=None):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.fallback = fallback
+
+def run_with_timeout(fn, timeout, *args):
+    """Run fn in a daemon thread. Returns ('ok', value), ('error', exc) or ('timeout', None).
+    A timed-out call keeps running in the background but can't hold the process open."""
+    box = {}
+    def work():
+        try:
+            box['value'] = fn(*args)
+        except BaseException as e:
+            box['error'] = e
+    t = threading.Thread(target=work, daemon=True)
+    t.start()
+    t.join(timeout)
+    if 'value' in box: return 'ok', box['value']
+    if 'error' in box: return 'error', box['error']
+    return 'timeout', None
+
+def run_stages(stages):
+    """Run stages as soon as their dependencies resolve, independent branches in parallel.
+    Each stage's return value is passed positionally to its dependents in `deps` order."""
+    results = {}
+    ready = {s.name: threading.Event() for s in stages}
+
+    def runner(stage):
+        for d in stage.deps:
+            ready[d].wait()
+        try:
+            failed = next((results[d] for d in stage.deps if isinstance(results[d], BaseException)), None)
+            if failed is not None:
+                results[stage.name] = failed  # required upstream stage died, nothing to run on
+                RUN_REPORT.record(f"stage.{stage.name}", 0.0, 'skipped')
+                return
+            started = time.perf_counter()
+            with RUN_REPORT.memory_span() as mem:
+                status, value = run_with_timeout(RUN_REPORT.profiled(stage.fn), stage.timeout, *[results[d] for d in stage.deps])
+            elapsed = time.perf_counter() - started
+            if status == 'ok':
+                results[stage.name] = value
+                RUN_REPORT.record(f"stage.{stage.name}", elapsed, **mem)
+                print(f"⏱️ {stage.name} finished in {elapsed:.1f}s")
+                return
+            reason = f"timed out after {stage.timeout}s" if status == 'timeout' else f"{type(value).__name__}: {value}"
+            if stage.fallback is None or isinstance(value, PipelineAbort):
+                results[stage.name] = value if status == 'error' else TimeoutError(f"{stage.name} {reason}")
+                RUN_REPORT.record(f"stage.{stage.name}", elapsed, status, error=reason, **mem)
             else:
-                rows += f"<td style='text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val}</td>"
-        rows += "</tr>"
-    return rows
-
-def make_watchlist_rows(left_df, right_df, cols):
-    """Generate watchlist rows with two columns side by side, separated by a vertical divider."""
-    rows = ""
-    max_len = max(len(left_df), len(right_df))
-    
-    left_list = left_df.to_dict('records')
-    right_list = right_df.to_dict('records')
-    
-    for i in range(max_len):
-        rows += "<tr>"
-        
-        # Left side columns
-        if i < len(left_list):
-            r = left_list[i]
-            for c in cols:
-                val = r[c]
-                if c == "Ticker":
-                    rows += f"<td style='text-align:left; font-weight:bold; padding:6px; border-bottom:1px solid #f0f0f0;'>{val}</td>"
-                elif isinstance(val, (float, int)):
-                    if "Pct" in c:
-                        color = "#27ae60" if val >= 0 else "#c0392b"
-                        rows += f"<td style='color:{color}; text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:+.2f}%</td>"
-                    else:
-                        rows += f"<td style='text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:,.2f}</td>"
-                else:
-                    rows += f"<td style='text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val}</td>"
-        else:
-            # Empty cells for left side
-            for _ in cols:
-                rows += "<td style='padding:6px; border-bottom:1px solid #f0f0f0;'>&nbsp;</td>"
-        
-        # Vertical divider cell
-        rows += "<td style='width:2px; background-color:#ccc; padding:0;'></td>"
-        
-        # Right side columns
-        if i < len(right_list):
-            r = right_list[i]
-            for c in cols:
-                val = r[c]
-                if c == "Ticker":
-                    rows += f"<td style='text-align:left; font-weight:bold; padding:6px; border-bottom:1px solid #f0f0f0;'>{val}</td>"
-                elif isinstance(val, (float, int)):
-                    if "Pct" in c:
-                        color = "#27ae60" if val >= 0 else "#c0392b"
-                        rows += f"<td style='color:{color}; text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:+.2f}%</td>"
-                    else:
-                        rows += f"<td style='text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val:,.2f}</td>"
-                else:
-                    rows += f"<td style='text-align:right; padding:6px; border-bottom:1px solid #f0f0f0;'>{val}</td>"
-        else:
-            # Empty cells for right side
-            for _ in cols:
-                rows += "<td style='padding:6px; border-bottom:1px solid #f0f0f0;'>&nbsp;</td>"
-        
-        rows += "</tr>"
-    
-    return rows
+                print(f"⚠️ Stage '{stage.name}' {reason}. Using fallback.")
+                results[stage.name] = stage.fallback(reason)
+                RUN_REPORT.record(f"stage.{stage.name}", elapsed, 'fallback', error=reason, **mem)
+        finally:
+            ready[stage.name].set()
 
-def main():
-    print("🚀 TO THE MOON INITIATED.")
-    sh = get_sheet_data()
-    port_ws = sh.worksheet("Portfolio")
-    watch_ws = sh.worksheet("Watchlist")
-    hist_ws = sh.worksheet("History_Log")
-    
-    port_df = pd.DataFrame(port_ws.get_all_records())
-    watch_df = pd.DataFrame(watch_ws.get_all_records())
-    
+    threads = [threading.Thread(target=runner, args=(s,), daemon=True) for s in stages]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return results
+
+def prepare_portfolio(records):
+    port_df = pd.DataFrame(records)
     port_df.columns = [c.replace(' ', '_') for c in port_df.columns]
     
     for col in ['Shares', 'Cost_Basis']:
@@ -282,81 +1749,213 @@ def main():
     
     if 'Cost_Basis' not in port_df.columns:
         port_df['Cost_Basis'] = 0.0
+    return port_df
 
-    all_tickers = list(set(list(port_df['Ticker']) + list(watch_df['Ticker'])))
-    all_tickers = ['^VIX' if t == '.VIX' else t for t in all_tickers]
+def fetch_all_market_data(port_df, watch_df):
+    """(market_df, close): returns for every ticker plus the Close panel the risk engine reads."""
+    all_tickers = list(set(list(port_df['Ticker']) + list(watch_df['Ticker']) + [RISK_BENCHMARK, VIX_TICKER]))
+    market_df, close = fetch_market_data(all_tickers)
+    if market_df.empty: raise PipelineAbort("no market data")
+    return market_df, close
 
-    market_df = fetch_market_data(all_tickers)
-    if market_df.empty: return
-    market_df['Ticker'] = market_df['Ticker'].replace('^VIX', '.VIX')
+def risk_panel(close, port_df):
+    """The columns of `close` the risk engine needs for one portfolio (holdings + benchmark)."""
+    return close.loc[:, close.columns.isin(set(port_df['Ticker']) | {RISK_BENCHMARK})]
 
+def compute_portfolio(port_df, watch_df, market_df, close=None):
     # --- PORTFOLIO CALCS ---
     port_merged = port_df.merge(market_df, on="Ticker")
-    
+
     # 1. Clean Data Types
     port_merged['Cost_Basis'] = port_merged['Cost_Basis'].astype(float)
     port_merged['Shares'] = port_merged['Shares'].astype(float)
     port_merged['Price'] = port_merged['Price'].astype(float)
-    
+
     # 2. Fix Zero Cost Basis
     port_merged.loc[port_merged['Cost_Basis'] <= 0, 'Cost_Basis'] = port_merged['Price']
-    
+
     # 3. Row Calcs
     port_merged['Value'] = port_merged['Shares'] * port_merged['Price']
     port_merged['Total_Gain_Loss'] = port_merged['Value'] - (port_merged['Shares'] * port_merged['Cost_Basis'])
     port_merged = port_merged.sort_values(by='Day_Chg_Pct', ascending=False)
-    
+
     # --- ROBUST TOTAL CALCS ---
     total_val = port_merged['Value'].sum()
     total_cost = (port_merged['Shares'] * port_merged['Cost_Basis']).sum()
-    
+
     # FIX: Sum the individual row Total_Gain_Loss values to match the displayed column
     total_gain_loss = port_merged['Total_Gain_Loss'].sum()
-    
+
     # Total Gain % (Overall)
     total_gain_pct = ((total_val - total_cost) / total_cost * 100) if total_cost > 0 else 0
-    
+
     # RECONSTRUCTED YESTERDAY'S VALUE (For accurate daily %)
     # Yesterday Value = Current Value / (1 + Day%/100)
     port_merged['Prev_Value'] = port_merged['Value'] / (1 + (port_merged['Day_Chg_Pct'] / 100))
     total_prev_val = port_merged['Prev_Value'].sum()
-    
+
     # Day Dollar Gain (Actual Difference)
     day_gain_dollar = total_val - total_prev_val
-    
+
     # Weighted Day % 
     day_change_pct = ((total_val - total_prev_val) / total_prev_val * 100) if total_prev_val > 0 else 0
 
     # RECONSTRUCTED MONTH AGO VALUE
     port_merged['Prev_Month_Value'] = port_merged['Value'] / (1 + (port_merged['Month_Chg_Pct'] / 100))
     total_prev_month_val = port_merged['Prev_Month_Value'].sum()
-    
+
     # Weighted Month %
     total_month_pct = ((total_val - total_prev_month_val) / total_prev_month_val * 100) if total_prev_month_val > 0 else 0
 
+    # RISK (vol, beta, P&L and risk contribution per holding; needs the Close panel)
+    risk = None
+    if close is not None and not port_merged.empty:
+        with RUN_REPORT.timed("risk", tickers=len(port_merged)):
+            risk_cols, risk = compute_risk(close, port_merged['Ticker'], port_merged['Value'], port_merged['Prev_Value'])
+        for col in risk_cols:
+            port_merged[col] = risk_cols[col].to_numpy()
+
+    vix = market_df[market_df['Ticker'] == VIX_TICKER]
+    vix = {'price': float(vix['Price'].iloc[0]), 'day_pct': float(vix['Day_Chg_Pct'].iloc[0])} if len(vix) else None
+
     # --- WATCHLIST ---
     watch_merged = watch_df.merge(market_df, on="Ticker").sort_values(by='Day_Chg_Pct', ascending=False)
-    
+
+    # Download failures / dropped tickers for this account only (batch shares one market_df)
+    mine = set(port_df['Ticker']) | set(watch_df['Ticker'])
+    data_issues = {t: r for t, r in market_df.attrs.get('issues', {}).items() if t in mine}
+
     mid_idx = math.ceil(len(watch_merged) / 2)
     watch_left = watch_merged.iloc[:mid_idx]
     watch_right = watch_merged.iloc[mid_idx:]
 
+    return {
+        "port_merged": port_merged, "watch_merged": watch_merged,
+        "watch_left": watch_left, "watch_right": watch_right,
+        "total_val": total_val, "total_gain_loss": total_gain_loss, "total_gain_pct": total_gain_pct,
+        "day_gain_dollar": day_gain_dollar, "day_change_pct": day_change_pct, "total_month_pct": total_month_pct,
+        "risk": risk, "vix": vix, "data_issues": data_issues,
+    }
+
+def today_str():
     tz = pytz.timezone('America/Los_Angeles')
-    today = datetime.now(tz).strftime("%Y-%m-%d")
-    hist_records = hist_ws.get_all_records()
-    existing_dates = [str(r['Date']) for r in hist_records]
-    
-    if today in existing_dates:
-        # Find the row number (add 2: 1 for header, 1 for 0-index)
-        row_idx = existing_dates.index(today) + 2
-        hist_ws.update(values=[[today, total_val, total_gain_loss]], range_name=f'A{row_idx}:C{row_idx}')
-        print(f"📝 Updated existing row for {today}")
-    else:
-        hist_ws.append_row([today, total_val, total_gain_loss])
-        print(f"📝 Added new row for {today}")
+    return datetime.now(tz).strftime("%Y-%m-%d")
+
+def format_history_stats(stats):
+    """One-line rolling performance strip for the email header."""
+    if not stats: return ""
+    def pct(v):
+        if v is None: return "n/a"
+        return f"<span style='color:{'#27ae60' if v >= 0 else '#c0392b'}'>{v:+.2f}%</span>"
+    parts = [f"{d}D {pct(stats.get(f'chg_{d}d_pct'))}" for d in ROLLING_WINDOWS]
+    parts.append(f"Max DD {pct(stats.get('max_drawdown_pct'))}")
+    parts.append(f"High-Water ${stats.get('hwm', 0):,.0f}")
+    return " &nbsp;|&nbsp; ".join(parts)
+
+def format_risk_summary(risk):
+    """Portfolio-level risk numbers, one line. Shared by the email and the AI prompt."""
+    parts = [f"Vol {risk['port_vol_pct']:.1f}% ann."]
+    if risk['port_beta'] is not None: parts.append(f"Beta {risk['port_beta']:.2f} vs {RISK_BENCHMARK}")
+    if risk['avg_corr'] is not None: parts.append(f"Avg corr {risk['avg_corr']:.2f}")
+    parts.append(f"Top 5 = {risk['top5_weight_pct']:.0f}% of value")
+    parts.append(f"Effective N {risk['effective_n']:.1f}")
+    if risk['largest']: parts.append(f"Largest {risk['largest'][0]} {risk['largest'][1]:.1f}%")
+    return " | ".join(parts)
+
+def render_risk_section(ctx):
+    risk = ctx.get('risk')
+    if not risk: return ""
+    drivers = ctx['port_merged'].nlargest(RISK_TABLE_ROWS, 'Risk_Contrib_Pct')
+    pairs = ", ".join(f"{a}/{b} {rho:.2f}" for a, b, rho in risk['top_pairs'][:3])
+    return f"""
+        <!-- Risk Section -->
+        <table width="100%" cellpadding="0" cellspacing="0" border="0" style="margin-top: 25px;">
+            <tr>
+                <td style="border: 1px solid #eee; padding: 15px; border-radius: 5px;">
+                    <h3 style="margin-top: 0;">⚖️ Risk ({risk['lookback_bars']}-day)</h3>
+                    <div style="font-size: 12px; color: #666; margin-bottom: 10px;">{format_risk_summary(risk)}{f" | Most correlated: {pairs}" if pairs else ""}</div>
+                    <table width="100%" cellpadding="0" cellspacing="0" border="0" style="font-size: 11px;">
+                        <tr>{render_header(RISK_COLS)}</tr>
+                        {render_rows(drivers, RISK_COLS)}
+                    </table>
+                </td>
+            </tr>
+        </table>
+        """
+
+def render_alerts(alerts):
+    if not alerts or not alerts['fired']: return ""
+    items = "".join(f"<li>{msg}</li>" for msg in alerts['fired'][:ALERT_DISPLAY_MAX])
+    if len(alerts['fired']) > ALERT_DISPLAY_MAX: items += f"<li>+{len(alerts['fired']) - ALERT_DISPLAY_MAX} more</li>"
+    return f"""
+        <!-- Alerts -->
+        <table width="100%" cellpadding="0" cellspacing="0" border="0" style="margin-bottom: 20px;">
+            <tr>
+                <td style="background-color: #fff4e5; padding: 12px 15px; border-left: 5px solid #e67e22; border-radius: 4px; font-size: 13px;">
+                    <b>🔔 Alerts</b>
+                    <ul style="margin: 6px 0 0 0; padding-left: 20px;">{items}</ul>
+                </td>
+            </tr>
+        </table>
+        """
+
+def render_data_issues(issues):
+    if not issues: return ""
+    shown = list(issues.items())[:ALERT_DISPLAY_MAX]
+    more = f"; +{len(issues) - len(shown)} more" if len(issues) > len(shown) else ""
+    return f"""
+        <div style="font-size: 11px; color: #999; margin-bottom: 15px;">
+            ⚠️ Data issues ({len(issues)}): {"; ".join(f"<b>{t}</b> {r}" for t, r in shown)}{more}
+        </div>
+        """
+
+def build_digest_html(ctx, history_stats=None):
+    """Short quiet-session email: totals and the few biggest movers, no Gemini, no chart."""
+    port_merged, total_val = ctx['port_merged'], ctx['total_val']
+    day_gain_dollar, day_change_pct = ctx['day_gain_dollar'], ctx['day_change_pct']
+    movers = port_merged.reindex(port_merged['Day_Chg_Pct'].abs().nlargest(DIGEST_ROWS).index)
+    return f"""
+    <html>
+    <head>
+    <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+    </head>
+    <body style="font-family: Helvetica, Arial, sans-serif; color: #333; background-color: #ffffff; margin: 0; padding: 20px;">
+        <h2 style="margin: 0;">💤 Market Pulse: ${total_val:,.0f} 
+            <span style="color:{'#27ae60' if day_gain_dollar>=0 else '#c0392b'}">({day_gain_dollar:+,.0f})</span>
+            <span style="font-size: 16px; color:{'#27ae60' if day_change_pct>=0 else '#c0392b'}"> {day_change_pct:+.2f}%</span>
+        </h2>
+        <div style="font-size: 12px; color: #666; margin-top: 6px;">{format_history_stats(history_stats)}</div>
+        <p style="font-size: 13px;">Quiet session: no alert thresholds crossed. Biggest movers:</p>
+        {render_data_issues(ctx.get('data_issues'))}
+        <table cellpadding="0" cellspacing="0" border="0" style="font-size: 11px; min-width: 50%;">
+            <tr>{render_header(HOLDINGS_COLS)}</tr>
+            {render_rows(movers, HOLDINGS_COLS)}
+        </table>
+    </body>
+    </html>
+    """
+
+def top_movers(df, n):
+    """The n rows with the largest absolute day move, still sorted by Day %, and how many were left out."""
+    if n is None or len(df) <= n: return df, 0
+    return df.loc[df['Day_Chg_Pct'].abs().nlargest(n).index].sort_values('Day_Chg_Pct', ascending=False), len(df) - n
+
+def hidden_rows_note(hidden, colspan):
+    if not hidden: return ""
+    return (f"<tr><td colspan='{colspan}' style='padding:6px; color:#999; font-style:italic;'>"
+            f"+{hidden:,} more not shown (biggest day moves kept; totals cover everything)</td></tr>")
+
+def build_email_html(ctx, ai_text, history_stats=None, alerts=None, max_rows=None):
+    """Full briefing. max_rows cuts Holdings and each Watchlist to the biggest day moves."""
+    port_merged, hidden_port = top_movers(ctx['port_merged'], max_rows)
+    watch_left, watch_right, hidden_watch = ctx['watch_left'], ctx['watch_right'], 0
+    if max_rows is not None:
+        watch_shown, hidden_watch = top_movers(ctx['watch_merged'], max_rows)
+        mid_idx = math.ceil(len(watch_shown) / 2)
+        watch_left, watch_right = watch_shown.iloc[:mid_idx], watch_shown.iloc[mid_idx:]
+    total_val, total_gain_loss = ctx['total_val'], ctx['total_gain_loss']
+    day_gain_dollar, day_change_pct, total_month_pct = ctx['day_gain_dollar'], ctx['day_change_pct'], ctx['total_month_pct']
 
-    ai_text = get_ai_insights(port_merged, watch_merged, total_val, day_gain_dollar)
-    
     # --- HTML (Email-Safe with Inline Styles and Table-Based Layout) ---
     html = f"""
     <html>
@@ -373,10 +1972,12 @@ def main():
                         <span style="color:{'#27ae60' if day_gain_dollar>=0 else '#c0392b'}">({day_gain_dollar:+,.0f})</span>
                         <span style="font-size: 16px; color:{'#27ae60' if day_change_pct>=0 else '#c0392b'}"> {day_change_pct:+.2f}%</span>
                     </h2>
+                    <div style="font-size: 12px; color: #666; margin-top: 6px;">{format_history_stats(history_stats)}</div>
                 </td>
             </tr>
         </table>
-        
+        {render_alerts(alerts)}
+        {render_data_issues(ctx.get('data_issues'))}
         <!-- AI Section -->
         <table width="100%" cellpadding="0" cellspacing="0" border="0" style="margin-bottom: 25px;">
             <tr>
@@ -394,14 +1995,9 @@ def main():
                 <td width="48%" valign="top" style="border: 1px solid #eee; padding: 15px; border-radius: 5px; box-shadow: 0 2px 5px rgba(0,0,0,0.05);">
                     <h3 style="margin-top: 0;">💼 Holdings</h3>
                     <table width="100%" cellpadding="0" cellspacing="0" border="0" style="font-size: 11px;">
-                        <tr>
-                            <th style="background: #f8f9fa; text-align: left; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Ticker</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Price</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Day %</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Mth %</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Total G/L</th>
-                        </tr>
-                        {make_rows(port_merged, ['Ticker', 'Price', 'Day_Chg_Pct', 'Month_Chg_Pct', 'Total_Gain_Loss'])}
+                        <tr>{render_header(HOLDINGS_COLS)}</tr>
+                        {render_rows(port_merged, HOLDINGS_COLS)}
+                        {hidden_rows_note(hidden_port, len(HOLDINGS_COLS))}
                         <tr>
                             <td style="text-align: left; font-weight: bold; padding: 8px; border-top: 2px solid #ccc; background-color: #fafafa;">TOTAL</td>
                             <td style="text-align: right; font-weight: bold; padding: 8px; border-top: 2px solid #ccc; background-color: #fafafa;">-</td>
@@ -419,26 +2015,14 @@ def main():
                 <td width="48%" valign="top" style="border: 1px solid #eee; padding: 15px; border-radius: 5px; box-shadow: 0 2px 5px rgba(0,0,0,0.05);">
                     <h3 style="margin-top: 0;">👀 Watchlist</h3>
                     <table width="100%" cellpadding="0" cellspacing="0" border="0" style="font-size: 11px;">
-                        <tr>
-                            <!-- Left Column Headers -->
-                            <th style="background: #f8f9fa; text-align: left; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Ticker</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Price</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Day %</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Mth %</th>
-                            <!-- Divider -->
-                            <th style="width: 2px; background-color: #ccc; padding: 0; border-bottom: 2px solid #ccc;"></th>
-                            <!-- Right Column Headers -->
-                            <th style="background: #f8f9fa; text-align: left; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Ticker</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Price</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Day %</th>
-                            <th style="background: #f8f9fa; text-align: right; padding: 8px; color: #666; font-size: 10px; text-transform: uppercase; border-bottom: 2px solid #eee;">Mth %</th>
-                        </tr>
-                        {make_watchlist_rows(watch_left, watch_right, ['Ticker', 'Price', 'Day_Chg_Pct', 'Month_Chg_Pct'])}
+                        <tr>{render_header(WATCH_COLS)}{DIVIDER_HEADER}{render_header(WATCH_COLS)}</tr>
+                        {render_split_rows(watch_left, watch_right, WATCH_COLS)}
+                        {hidden_rows_note(hidden_watch, 2 * len(WATCH_COLS) + 1)}
                     </table>
                 </td>
             </tr>
         </table>
-        
+        {render_risk_section(ctx)}
         <!-- Chart Section -->
         <table width="100%" cellpadding="0" cellspacing="0" border="0" style="margin-top: 25px;">
             <tr>
@@ -452,11 +2036,437 @@ def main():
     </body>
     </html>
     """
+    return html
+
+def report_stages(store, history, today, alerts):
+    """Stages that turn a computed portfolio ("compute") into email parts. Shared by main() and batch mode.
+    Gemini and the chart are skipped when `alerts` (an AlertEngine) finds nothing new, unless QUIET_MODE is 'full'."""
+    def record_history(ctx):
+        history.sync(store.history)
+        history.append(today, ctx['total_val'], ctx['total_gain_loss'])
+        return history.stats
+
+    def write_history(ctx, stats):
+        # Runs after the local sync so it compares against the pre-upsert row count
+        store.upsert_history(today, ctx['total_val'], ctx['total_gain_loss'])
+
+    def evaluate(ctx, stats):
+        return alerts.evaluate(ctx, stats, today)
+
+    def chart(stats, fired):
+        if skip_when_quiet(fired): return None
+        with RUN_REPORT.timed("chart.render") as m:
+            buf = generate_chart(*history.window())
+            m['bytes'] = buf.getbuffer().nbytes if buf else 0
+        return buf
+
+    def ai(ctx, fired):
+        if skip_when_quiet(fired): return None
+        return get_ai_insights(ctx['port_merged'], ctx['watch_merged'], ctx['total_val'], ctx['day_gain_dollar'], ctx.get('risk'))
+
+    # Stages with a fallback degrade the email instead of blocking it
+    return [
+        Stage("history_local", record_history, deps=["compute"], fallback=lambda reason: {}),
+        Stage("history_write", write_history, deps=["compute", "history_local"], timeout=STAGE_TIMEOUTS['sheets'],
+              fallback=lambda reason: None),
+        # A broken rule must not hide a briefing: fall back to "not quiet" and send it all
+        Stage("alerts", evaluate, deps=["compute", "history_local"],
+              fallback=lambda reason: {'fired': [], 'active': [], 'quiet': False, 'state': None}),
+        Stage("ai", ai, deps=["compute", "alerts"], timeout=STAGE_TIMEOUTS['ai'],
+              fallback=lambda reason: f"<i>AI Analysis Unavailable: {reason}</i>"),
+        Stage("chart", chart, deps=["history_local", "alerts"], timeout=STAGE_TIMEOUTS['chart'],
+              fallback=lambda reason: None),
+    ]
+
+def finish_report(results):
+    """(subject, html, chart) from run_stages results, or None if the run was aborted or the
+    quiet session is skipped."""
+    errors = [v for v in results.values() if isinstance(v, BaseException)]
+    if errors:
+        if isinstance(errors[0], PipelineAbort):
+            print(f"🛑 Nothing to send: {errors[0]}")
+            return None
+        raise errors[0]
+
+    report = render_report(results['compute'], results['ai'], results['history_local'], results['alerts'])
+    return None if report is None else report + (results['chart'],)
+
+def render_report(ctx, ai_text, history_stats, alerts):
+    """(subject, html): the full briefing, or the quiet-session digest. None when QUIET_MODE is 'skip'."""
+    if skip_when_quiet(alerts):
+        if QUIET_MODE == 'skip':
+            print("🔕 Quiet session, no email (QUIET_MODE=skip).")
+            return None
+        with RUN_REPORT.timed("render_html", rows=DIGEST_ROWS, digest=True) as m:
+            html = compact_html(build_digest_html(ctx, history_stats))
+            m['bytes'] = len(html.encode())
+        return f"📊 Market Pulse (quiet): ${ctx['total_val']:,.0f}", html
+    with RUN_REPORT.timed("render_html", rows=len(ctx['port_merged']) + len(ctx['watch_merged'])) as m:
+        html, m['max_rows'] = fit_email_html(lambda rows: build_email_html(ctx, ai_text, history_stats, alerts, rows))
+        m['bytes'] = len(html.encode())
+    return f"📊 Market Pulse: ${ctx['total_val']:,.0f}", html
+
+def main():
+    """True when the briefing went out, None when there was deliberately nothing to send
+    (QUIET_MODE=skip), False when a PipelineAbort stopped the run (e.g. no market data)."""
+    print("🚀 TO THE MOON INITIATED.")
+    store = SheetStore(get_sheet_data())
+    history = HistoryStore.for_sheet(SHEET_NAME)
+    alerts = AlertEngine(SHEET_NAME)
+    today = today_str()
+
+    def read_sheets():
+        records = store.load()
+        return prepare_portfolio(records["Portfolio"]), pd.DataFrame(records["Watchlist"])
+
+    results = run_stages([
+        Stage("sheets", read_sheets, timeout=STAGE_TIMEOUTS['sheets']),
+        Stage("market", lambda frames: fetch_all_market_data(*frames), deps=["sheets"], timeout=STAGE_TIMEOUTS['market']),
+        Stage("compute", lambda frames, market: compute_portfolio(*frames, *market), deps=["sheets", "market"]),
+    ] + report_stages(store, history, today, alerts))
+
+    report = finish_report(results)
+    if report is None:
+        return False if any(isinstance(v, PipelineAbort) for v in results.values()) else None
     
     print("📧 Sending email...")
-    hist_data = hist_ws.get_all_records()
-    send_email(f"📊 Market Pulse: ${total_val:,.0f}", html, generate_chart(hist_data))
+    send_email(*report)
+    alerts.commit(results['alerts'])
     print("✅ Done.")
+    return True
+
+def load_accounts(path):
+    """Batch config: JSON list of {"sheet": "<workbook name>", "recipients": ["a@x.com", ...]}.
+    Recipients default to GMAIL_USER."""
+    with open(path) as f:
+        accounts = json.load(f)
+    for acct in accounts:
+        acct.setdefault("recipients", [os.environ["GMAIL_USER"]])
+    return accounts
+
+def run_batch(accounts, workers=1):
+    """Many portfolios, one run: one Yahoo fetch for the union of tickers and one SMTP login.
+    A failing account (sheet read, compute, report or send) is logged and skipped; the rest
+    still go out. Returns True only if every account succeeded."""
+    print(f"🚀 BATCH MODE: {len(accounts)} portfolios")
+    today = today_str()
+    failed = {}
+
+    def isolated(step, fn):
+        def run(acct, *args):
+            try:
+                return fn(acct, *args)
+            except Exception as e:
+                failed.setdefault(acct['sheet'], f"{step}: {type(e).__name__}: {e}")
+                RUN_REPORT.record(f"batch.{step}", 0, 'error', account=acct['sheet'], error=f"{type(e).__name__}: {e}")
+                print(f"❌ {acct['sheet']} failed at {step}: {type(e).__name__}: {e}")
+                return None
+        return run
+
+    def read(acct):
+        store = SheetStore(get_sheet_data(acct['sheet']))
+        records = store.load()
+        return store, prepare_portfolio(records["Portfolio"]), pd.DataFrame(records["Watchlist"])
+
+    with ThreadPoolExecutor(max_workers=min(8, len(accounts))) as pool:
+        loaded = list(pool.map(isolated("read", read), accounts))
+    accounts, loaded = [a for a, l in zip(accounts, loaded) if l is not None], [l for l in loaded if l is not None]
+    if not accounts:
+        print("🛑 No portfolio could be read.")
+        return False
+
+    try:
+        market_df, close = fetch_all_market_data(pd.concat([p for _, p, _ in loaded]), pd.concat([w for _, _, w in loaded]))
+    except PipelineAbort as e:  # shared by every account: nothing to compute for anyone
+        print(f"🛑 Nothing to send: {e}")
+        return False
+    ports, watches = [p for _, p, _ in loaded], [w for _, _, w in loaded]
+    panels = [risk_panel(close, p) for p in ports]  # each worker only gets its own columns
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(compute_portfolio, p, w, market_df, c) for p, w, c in zip(ports, watches, panels)]
+            contexts = [isolated("compute", lambda acct, f: f.result())(a, f) for a, f in zip(accounts, futures)]
+    else:
+        compute = isolated("compute", lambda acct, p, w, c: compute_portfolio(p, w, market_df, c))
+        contexts = [compute(a, p, w, c) for a, p, w, c in zip(accounts, ports, watches, panels)]
+
+    def report(acct, store, ctx):
+        if ctx is None: return None  # compute already failed and was logged
+        history, alerts = HistoryStore.for_sheet(acct['sheet']), AlertEngine(acct['sheet'])
+        results = run_stages([Stage("compute", lambda: ctx)] + report_stages(store, history, today, alerts))
+        return finish_report(results), alerts, results.get('alerts')
+
+    with ThreadPoolExecutor(max_workers=min(8, len(accounts))) as pool:
+        reports = list(pool.map(isolated("report", report), accounts, [s for s, _, _ in loaded], contexts))
+
+    def send(acct, rep, alerts, evaluation, smtp):
+        send_email(*rep, recipients=acct['recipients'], smtp=smtp)
+        alerts.commit(evaluation)
+        print(f"📧 {acct['sheet']} -> {', '.join(acct['recipients'])}")
+
+    ready = [(a, r) for a, r in zip(accounts, reports) if r is not None and r[0] is not None]
+    print(f"📧 Sending {len(ready)} emails over one SMTP session...")
+    if ready:
+        with open_smtp() as smtp:
+            for acct, (rep, alerts, evaluation) in ready:
+                isolated("send", send)(acct, rep, alerts, evaluation, smtp)
+    if failed:
+        print(f"⚠️ {len(failed)} portfolio(s) failed: " + "; ".join(f"{k} ({v})" for k, v in failed.items()))
+        return False
+    print("✅ Done.")
+    return True
+
+# --- SUBCOMMANDS ---
+# Each step runs one piece of main() and saves its result to ARTIFACT_DIR. A step loads the
+# artifacts it depends on, or builds them first when they're missing or stale, so
+# `fetch && compute && history` and a bare `history` do the same work.
+def artifact_path(name):
+    return os.path.join(ARTIFACT_DIR, f"{name}.pkl")
+
+def save_artifact(name, value):
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    path = artifact_path(name)
+    with RUN_REPORT.timed(f"artifact.save.{name}") as m:
+        with open(path + ".tmp", 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        m['bytes'] = os.path.getsize(path)
+
+def load_artifact(name):
+    """(found, value); not found when missing or older than ARTIFACT_MAX_AGE_MINUTES."""
+    path = artifact_path(name)
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > ARTIFACT_MAX_AGE_MINUTES * 60:
+        return False, None
+    with RUN_REPORT.timed(f"artifact.load.{name}") as m:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+        m['bytes'] = os.path.getsize(path)
+    return True, value
+
+def need(name):
+    found, value = load_artifact(name)
+    if found: return value
+    print(f"🧩 No fresh '{name}' artifact, building it...")
+    return run_step(name)
+
+def run_step(name):
+    value = STEPS[name]()
+    if name != "send": save_artifact(name, value)
+    return value
+
+def report_step(names, inputs, store=None):
+    """Run some of report_stages() on their own; `inputs` stands in for their upstream stages."""
+    stages = [s for s in report_stages(store, HistoryStore.for_sheet(SHEET_NAME), today_str(), AlertEngine(SHEET_NAME))
+              if s.name in names]
+    return run_stages([Stage(k, lambda v=v: v) for k, v in inputs.items()] + stages)
+
+def step_fetch():
+    records = SheetStore(get_sheet_data()).load()
+    port_df, watch_df = prepare_portfolio(records["Portfolio"]), pd.DataFrame(records["Watchlist"])
+    market_df, close = fetch_all_market_data(port_df, watch_df)
+    return {'records': records, 'portfolio': port_df, 'watchlist': watch_df,
+            'market': market_df, 'close': risk_panel(close, port_df)}
+
+def step_compute():
+    fetched = need("fetch")
+    return compute_portfolio(fetched['portfolio'], fetched['watchlist'], fetched['market'], fetched['close'])
+
+def step_history():
+    """History_Log update on its own: sheet + prices + math, no Gemini or matplotlib."""
+    ctx = need("compute")
+    # Always re-read History_Log: the fetch artifact's copy predates any earlier `history` run,
+    # and upserting against it would append today's row a second time
+    store = SheetStore(get_sheet_data())
+    store.load(["History_Log"])
+    return report_step(("history_local", "history_write"), {'compute': ctx}, store)['history_local']
+
+def step_history_local():
+    """The local History_Log mirror brought up to date from the fetch artifact's records,
+    without writing the sheet. The mirror then counts one row more than the sheet, so the
+    next sync against the real sheet reseeds it."""
+    store = SheetStore(None)
+    store.restore(need("fetch")['records'])
+    return report_step(("history_local",), {'compute': need("compute")}, store)['history_local']
+
+def local_history():
+    """History stats for steps that only preview (alerts, ai, chart, render): a fresh `history`
+    artifact if there is one, else a local-only sync. Only history, send and run write the sheet."""
+    found, value = load_artifact("history")
+    return value if found else need("history_local")
+
+def step_alerts():
+    return report_step(("alerts",), {'compute': need("compute"), 'history_local': local_history()})['alerts']
+
+def step_ai():
+    return report_step(("ai",), {'compute': need("compute"), 'alerts': need("alerts")})['ai']
+
+def step_chart():
+    """{size: PNG bytes} for every CHART_SIZES entry; send attaches CHART_SIZE."""
+    local_history()  # brings the local History_Log mirror up to date
+    if skip_when_quiet(need("alerts")): return {}
+    charts = generate_charts(*HistoryStore.for_sheet(SHEET_NAME).window())
+    return {size: buf.getvalue() for size, buf in charts.items()}
+
+def step_render():
+    return render_report(need("compute"), need("ai"), local_history(), need("alerts"))
+
+def step_send():
+    need("history")  # the briefing that goes out records today in History_Log, like `run`
+    report = need("render")
+    if report is None: return
+    chart = need("chart").get(CHART_SIZE)
+    send_email(*report, io.BytesIO(chart) if chart else None)
+    AlertEngine(SHEET_NAME).commit(need("alerts"))
+    print("✅ Done.")
+
+STEPS = {'fetch': step_fetch, 'compute': step_compute, 'history': step_history, 'history_local': step_history_local, 'alerts': step_alerts,
+         'ai': step_ai, 'chart': step_chart, 'render': step_render, 'send': step_send}
+
+# --- DAEMON ---
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    """Full-day NYSE closures. New Year's on a Saturday is not made up on the Friday before."""
+    rules = [
+        Holiday('NewYearsDay', month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+        Holiday('IndependenceDay', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas', month=12, day=25, observance=nearest_workday),
+    ]
+
+@lru_cache(maxsize=None)
+def nyse_holidays(year):
+    return set(NYSEHolidayCalendar().holidays(f"{year}-01-01", f"{year}-12-31").date)
+
+def is_trading_day(day):
+    return day.weekday() < 5 and day not in nyse_holidays(day.year)
+
+def next_run_time(now, schedule=DAEMON_SCHEDULE_UTC):
+    """First slot in `schedule` (UTC "HH:MM") after `now` that falls on an NYSE trading day."""
+    ny = pytz.timezone('America/New_York')
+    for offset in range(15):  # longest closure plus a weekend is well under two weeks
+        day = (now + timedelta(days=offset)).date()
+        for slot in sorted(schedule):
+            hh, mm = map(int, slot.split(":"))
+            at = pytz.utc.localize(datetime(day.year, day.month, day.day, hh, mm))
+            if at > now and is_trading_day(at.astimezone(ny).date()):
+                return at
+    raise RuntimeError(f"No trading day in the next two weeks after {now:%Y-%m-%d}")
+
+DAEMON_STATE = {'started': None, 'next_run': None, 'last_run': None, 'last_status': None,
+                'last_error': None, 'runs': 0, 'failures': 0}
+LAST_REPORT = None
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """GET /health -> daemon state, GET /metrics -> the last run report."""
+    def do_GET(self):
+        if self.path == "/health":
+            body = {**DAEMON_STATE, 'peak_rss_mb': peak_rss_mb()}
+        elif self.path == "/metrics":
+            body = LAST_REPORT
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body, default=str).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass  # health probes would drown out the run logs
+
+def start_health_server(port, host=DAEMON_HOST):
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    print(f"🩺 Health endpoint on {host}:{server.server_address[1]} (/health, /metrics)")
+    return server
+
+def run_daemon(port=DAEMON_PORT, schedule=DAEMON_SCHEDULE_UTC, profile=False, host=DAEMON_HOST):
+    """Stay resident and run main() at every scheduled slot. Clients, the price cache and the
+    History_Log mirror are set up once and reused, so a briefing skips the cold boot."""
+    global LAST_REPORT
+    print("🛰️ DAEMON MODE: warming up...")
+    PROVIDERS.warm_up([SHEET_NAME])
+    keep_price_cache_open()
+    HistoryStore.resident = {}
+    DAEMON_STATE['started'] = datetime.now(pytz.utc).isoformat()
+    server = start_health_server(port, host) if port else None
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    while not stop.is_set():
+        at = next_run_time(datetime.now(pytz.utc), schedule)
+        DAEMON_STATE['next_run'] = at.isoformat()
+        print(f"⏰ Next briefing at {at:%a %Y-%m-%d %H:%M} UTC")
+        # Short waits so a suspended host or clock jump can't oversleep a slot
+        while not stop.is_set() and datetime.now(pytz.utc) < at:
+            stop.wait(min(60, (at - datetime.now(pytz.utc)).total_seconds()))
+        if stop.is_set(): break
+
+        DAEMON_STATE['last_run'] = datetime.now(pytz.utc).isoformat()
+        DAEMON_STATE['runs'] += 1
+        try:
+            sent = run_with_report("daemon", main, profile=profile)
+            DAEMON_STATE['last_status'] = {True: 'sent', None: 'quiet', False: 'aborted'}[sent]
+            DAEMON_STATE['last_error'] = None
+        except Exception as e:  # one bad run must not take the schedule down
+            DAEMON_STATE['failures'] += 1
+            DAEMON_STATE['last_status'] = 'error'
+            DAEMON_STATE['last_error'] = repr(e)
+            print(f"❌ Scheduled run failed: {e}")
+        LAST_REPORT = RUN_REPORT.to_dict()
+
+    print("👋 Daemon stopping.")
+    if server: server.shutdown()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="AI Market Pulse briefing")
+    parser.add_argument("--record", metavar="DIR", help="save sheet reads, prices and the AI answer as replayable fixtures")
+    parser.add_argument("--replay", metavar="DIR", help="run offline from fixtures saved with --record (no sheet writes, no email, caches in a temp dir)")
+    parser.add_argument("--profile", action="store_true", help=f"also dump a cProfile .prof next to the run report in {REPORT_DIR}")
+    parser.add_argument("--trace-memory", action="store_true", default=TRACE_MEMORY,
+                        help="record each stage's peak traced memory in the run report (slower)")
+    parser.add_argument("--quiet-mode", choices=["digest", "skip", "full"], default=QUIET_MODE,
+                        help="what to send when no alert fires (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.add_parser("run", help="the whole briefing (default)")
+    for name, doc in [("fetch", "read the workbook and prices"), ("compute", "portfolio math"),
+                      ("history", "update History_Log only (no AI, no chart)"), ("alerts", "evaluate alert rules"),
+                      ("ai", "Gemini commentary"),
+                      ("chart", "trend chart"), ("render", "email HTML"), ("send", "email the rendered briefing")]:
+        commands.add_parser(name, help=doc if name == "send" else f"{doc}; result saved to {ARTIFACT_DIR}")
+    batch = commands.add_parser("batch", help="run every portfolio listed in a JSON file")
+    batch.add_argument("accounts", metavar="ACCOUNTS_JSON")
+    batch.add_argument("--workers", type=int, default=1, help="processes for per-portfolio math")
+    daemon = commands.add_parser("daemon", help=f"stay resident and run at {', '.join(DAEMON_SCHEDULE_UTC)} UTC on NYSE trading days")
+    daemon.add_argument("--port", type=int, default=DAEMON_PORT, help="/health and /metrics port (0 = off)")
+    daemon.add_argument("--host", default=DAEMON_HOST, help="address to bind /health and /metrics to (default: %(default)s)")
+    args = parser.parse_args()
+    QUIET_MODE = args.quiet_mode
+    TRACE_MEMORY = args.trace_memory
+    if args.record: PROVIDERS = RecordingProviders(args.record)
+    if args.replay:
+        PROVIDERS = ReplayProviders(args.replay)
+        set_cache_dir(tempfile.mkdtemp(prefix="market-pulse-replay-"))
+        print(f"🎞️ Replaying {args.replay}; local caches in {CACHE_DIR}")
+    if args.command == "daemon":
+        run_daemon(args.port, profile=args.profile, host=args.host)
+    elif args.command == "batch":
+        if not run_with_report("batch", run_batch, load_accounts(args.accounts), args.workers, profile=args.profile):
+            sys.exit(1)
+    elif args.command in STEPS:
+        try:
+            run_with_report(args.command, run_step, args.command, profile=args.profile)
+        except PipelineAbort as e:
+            print(f"🛑 {e}")
+            sys.exit(1)
+    elif run_with_report("run", main, profile=args.profile) is False:
+        sys.exit(1)  # aborted: fail the scheduled job instead of going green with no email